@@ -4,23 +4,43 @@ Connexion, sessions et modèles SQLAlchemy
 """
 
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, Float, ForeignKey, JSON
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, Float, ForeignKey, Index, text, update, case
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+import asyncio
+import logging
 
 from app.config import settings
 
+logger = logging.getLogger(__name__)
+
 # ========================================
 # DATABASE ENGINE
 # ========================================
 
 # Convertir URL PostgreSQL pour async
-DATABASE_URL = settings.DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://")
+# + cache des requêtes préparées côté dialecte SQLAlchemy/asyncpg (défaut : 100)
+DATABASE_URL = make_url(
+    settings.DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://")
+).update_query_dict({"prepared_statement_cache_size": "500"})
 
 engine = create_async_engine(
     DATABASE_URL,
     echo=settings.DEBUG,  # Log SQL queries en mode debug
+    pool_size=settings.POOL_SIZE,
+    max_overflow=settings.POOL_MAX_OVERFLOW,
+    pool_pre_ping=True,  # Détecte les connexions coupées par Render
+    pool_recycle=1800,  # Renouvelle les connexions toutes les 30 min
+    pool_timeout=30,
+    connect_args={
+        "statement_cache_size": 1000,  # Cache des requêtes préparées asyncpg
+        "server_settings": {"jit": "off"}
+    },
     future=True
 )
 
@@ -30,6 +50,28 @@ async_session_maker = async_sessionmaker(
     expire_on_commit=False
 )
 
+# Engine dédié aux écritures non critiques (flush groupé des last_login et re-hash) :
+# synchronous_commit=off évite d'attendre le fsync du WAL à chaque commit
+# (au pire quelques centaines de ms d'écritures perdues en cas de crash)
+audit_engine = create_async_engine(
+    DATABASE_URL,
+    echo=settings.DEBUG,
+    pool_size=2,
+    max_overflow=0,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    connect_args={
+        "server_settings": {"synchronous_commit": "off"}
+    },
+    future=True
+)
+
+audit_session_maker = async_sessionmaker(
+    audit_engine,
+    class_=AsyncSession,
+    expire_on_commit=False
+)
+
 Base = declarative_base()
 
 # ========================================
@@ -63,6 +105,29 @@ class User(Base):
     # Status
     is_active = Column(Boolean, default=True)
     is_verified = Column(Boolean, default=False)
+    
+    __table_args__ = (
+        # Login / inscription : WHERE lower(email) = ? (emails insensibles à la casse)
+        Index("ix_users_email_lower", func.lower(email), unique=True),
+    )
+    
+    # Quota restant : une seule définition, calculée en Python sur l'instance
+    # (toujours à jour après analyses_used += 1) et en SQL dans les requêtes
+    @hybrid_property
+    def analyses_remaining(self) -> int:
+        return max(0, self.analyses_limit - self.analyses_used)
+    
+    @analyses_remaining.expression
+    def analyses_remaining(cls):
+        return func.greatest(0, cls.analyses_limit - cls.analyses_used)
+    
+    @hybrid_property
+    def can_analyze(self) -> bool:
+        return self.analyses_used < self.analyses_limit
+    
+    @can_analyze.expression
+    def can_analyze(cls):
+        return cls.analyses_used < cls.analyses_limit
 
 
 class Subscription(Base):
@@ -106,9 +171,10 @@ class DCEAnalysis(Base):
     file_name = Column(String)
     file_size = Column(Integer)
     file_type = Column(String)
+    content_hash = Column(String(64), index=True)  # BLAKE2b-256 du fichier (cache d'analyse)
     
-    # Résultats de l'analyse (JSON)
-    analysis_result = Column(JSON)
+    # Résultats de l'analyse (JSONB : stockage binaire, pas de re-parsing à la lecture)
+    analysis_result = Column(JSONB)
     
     # Métadonnées projet
     project_name = Column(String)
@@ -126,6 +192,20 @@ class DCEAnalysis(Base):
     
     # Archivage
     is_archived = Column(Boolean, default=False)
+    
+    __table_args__ = (
+        # Historique : WHERE user_id = ? AND is_archived = false ORDER BY created_at DESC
+        # Index partiel : les analyses archivées n'y figurent pas
+        Index(
+            "ix_dce_user_created_active",
+            "user_id",
+            "created_at",
+            postgresql_where=text("is_archived = false")
+        ),
+    )
+    
+    # Récupère id + created_at via INSERT ... RETURNING (évite un db.refresh())
+    __mapper_args__ = {"eager_defaults": True}
 
 
 class GeneratedDocument(Base):
@@ -147,6 +227,11 @@ class GeneratedDocument(Base):
     
     # Expiration (optionnel - auto-delete après X jours)
     expires_at = Column(DateTime(timezone=True))
+    
+    __table_args__ = (
+        # Export : WHERE analysis_id = ? AND document_type = ?
+        Index("ix_gen_doc_analysis_type", "analysis_id", "document_type"),
+    )
 
 
 class AuditLog(Base):
@@ -162,20 +247,84 @@ class AuditLog(Base):
     resource_id = Column(Integer)
     
     # Détails
-    details = Column(JSON)
+    details = Column(JSONB)
     ip_address = Column(String)
     user_agent = Column(String)
     
     # Timestamp
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    __table_args__ = (
+        Index("ix_audit_user_created", "user_id", "created_at"),
+    )
 
 
 # ========================================
 # DATABASE FUNCTIONS
 # ========================================
 
+# ========================================
+# MISE À NIVEAU DU SCHÉMA
+# ========================================
+# create_all ne crée que les tables absentes : les colonnes, types et index ajoutés
+# depuis sont appliqués aux bases existantes par create_tables.py (migration ponctuelle,
+# jamais au démarrage de l'app : verrous de table et échec possible de l'index unique).
+# Instructions idempotentes, exécutées une à une en autocommit (index CONCURRENTLY)
+
+SCHEMA_UPGRADES = [
+    # Cache d'analyse par contenu (empreinte BLAKE2b-256 de l'upload)
+    "ALTER TABLE dce_analyses ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_dce_analyses_content_hash ON dce_analyses (content_hash)",
+    # JSON → JSONB (conversion seulement si la colonne est encore en json : pas de réécriture sinon)
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'dce_analyses' AND column_name = 'analysis_result' AND data_type = 'json'
+        ) THEN
+            ALTER TABLE dce_analyses ALTER COLUMN analysis_result TYPE jsonb USING analysis_result::jsonb;
+        END IF;
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'audit_logs' AND column_name = 'details' AND data_type = 'json'
+        ) THEN
+            ALTER TABLE audit_logs ALTER COLUMN details TYPE jsonb USING details::jsonb;
+        END IF;
+    END
+    $$
+    """,
+    # Login / inscription insensibles à la casse (échoue si des doublons de casse existent déjà)
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_lower ON users (lower(email))",
+    # Historique, export et audit (index composites / partiel)
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_dce_user_created_active ON dce_analyses (user_id, created_at) "
+    "WHERE is_archived = false",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_gen_doc_analysis_type ON generated_documents (analysis_id, document_type)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_audit_user_created ON audit_logs (user_id, created_at)",
+]
+
+
+async def upgrade_schema() -> List[str]:
+    """
+    Applique SCHEMA_UPGRADES (migration ponctuelle, voir create_tables.py)
+    Chaque instruction est indépendante : un échec est journalisé et n'empêche pas les
+    suivantes. Retourne les instructions en échec.
+    """
+    failed = []
+    async with engine.connect() as conn:
+        # CREATE INDEX CONCURRENTLY est interdit dans une transaction
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for statement in SCHEMA_UPGRADES:
+            try:
+                await conn.execute(text(statement))
+            except Exception:
+                logger.exception("Échec de la mise à niveau du schéma : %s", statement.strip())
+                failed.append(statement)
+    return failed
+
+
 async def init_db():
-    """Initialise la base de données (crée les tables)"""
+    """Initialise la base de données (crée les tables absentes)"""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
@@ -183,6 +332,80 @@ async def init_db():
 async def close_db():
     """Ferme les connexions"""
     await engine.dispose()
+    await audit_engine.dispose()
+
+
+# last_login en attente d'écriture (user_id → date), regroupés en un seul UPDATE
+LAST_LOGIN_FLUSH_INTERVAL_SECONDS = 5
+_pending_last_logins: Dict[int, datetime] = {}
+# Re-hash bcrypt en attente : user_id -> (hash actuel, nouveau hash)
+_pending_password_rehashes: Dict[int, Tuple[str, str]] = {}
+
+
+def touch_last_login(user_id: int):
+    """Planifie la mise à jour de last_login (écrite au prochain flush, hors requête)"""
+    _pending_last_logins[user_id] = datetime.now(timezone.utc)
+
+
+def touch_password_hash(user_id: int, current_hash: str, new_hash: str):
+    """Planifie le remplacement d'un hash bcrypt (écrit au prochain flush, hors requête)"""
+    _pending_password_rehashes[user_id] = (current_hash, new_hash)
+
+
+async def flush_last_logins():
+    """Écrit les last_login (et re-hash) en attente, un UPDATE chacun (via l'engine d'audit)"""
+    global _pending_last_logins, _pending_password_rehashes
+    if not _pending_last_logins and not _pending_password_rehashes:
+        return
+    
+    pending, _pending_last_logins = _pending_last_logins, {}
+    rehashes, _pending_password_rehashes = _pending_password_rehashes, {}
+    try:
+        await _write_pending(pending, rehashes)
+    except BaseException:
+        # Échec ou annulation en cours d'écriture : remise en attente pour le flush suivant
+        # (les entrées plus récentes, arrivées entre-temps, restent prioritaires)
+        _pending_last_logins = {**pending, **_pending_last_logins}
+        _pending_password_rehashes = {**rehashes, **_pending_password_rehashes}
+        raise
+
+
+async def _write_pending(pending: Dict[int, datetime], rehashes: Dict[int, Tuple[str, str]]):
+    async with audit_session_maker() as session:
+        if pending:
+            await session.execute(
+                update(User)
+                .where(User.id.in_(list(pending)))
+                .values(last_login=case(pending, value=User.id))
+            )
+        if rehashes:
+            # Seulement si le hash n'a pas changé entre-temps (changement de mot de passe)
+            await session.execute(
+                update(User)
+                .where(
+                    User.id.in_(list(rehashes)),
+                    User.hashed_password == case(
+                        {user_id: hashes[0] for user_id, hashes in rehashes.items()},
+                        value=User.id
+                    )
+                )
+                .values(hashed_password=case(
+                    {user_id: hashes[1] for user_id, hashes in rehashes.items()},
+                    value=User.id
+                ))
+                .execution_options(synchronize_session=False)
+            )
+        await session.commit()
+
+
+async def run_last_login_flusher():
+    """Tâche de fond : flush périodique des last_login (lancée au démarrage)"""
+    while True:
+        await asyncio.sleep(LAST_LOGIN_FLUSH_INTERVAL_SECONDS)
+        try:
+            await flush_last_logins()
+        except Exception:
+            logger.exception("Échec de la mise à jour groupée de last_login")
 
 
 async def get_db() -> AsyncSession:
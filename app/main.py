@@ -3,35 +3,80 @@ Point d'entrée principal de l'application FastAPI
 Configuration CORS RENFORCÉE pour monsieurlanding.fr
 """
 
-from fastapi import FastAPI
+from fastapi import FastAPI, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from starlette.types import Message, Receive, Scope, Send
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
+import asyncio
+import contextlib
 import logging
+import logging.handlers
+import os
+import queue
 
-from app.database import engine, Base
+from app.config import settings
+from app.database import init_db, run_last_login_flusher, flush_last_logins
 from app.routes import auth, users, analysis, subscriptions, export_routes
 
 # Configuration du logging
+# Par défaut (scripts, workers, tests sans lifespan) : écriture stderr directe.
+# Pendant la vie de l'app, les handlers du root logger sont remplacés par un QueueHandler :
+# un logger.info() depuis l'event loop ne fait qu'un put() non bloquant, l'écriture
+# stderr tourne dans le thread du QueueListener
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+
+def _start_log_listener() -> tuple:
+    """Basculer le root logger sur une queue ; retourne (listener, handlers d'origine)"""
+    root = logging.getLogger()
+    previous_handlers = root.handlers[:]
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *previous_handlers, respect_handler_level=True)
+    listener.start()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    return listener, previous_handlers
+
+
+def _stop_log_listener(listener, previous_handlers) -> None:
+    """Restaurer les handlers d'origine puis vider la queue"""
+    logging.getLogger().handlers = previous_handlers
+    listener.stop()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Gestion du cycle de vie de l'application"""
+    log_listener, previous_log_handlers = _start_log_listener()
     logger.info("🚀 Démarrage de Bid-Killer Engine API...")
     
-    # Créer les tables si elles n'existent pas
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Créer les tables si elles n'existent pas (mise à niveau du schéma : create_tables.py)
+    await init_db()
     
     logger.info("✅ Base de données connectée")
     
+    # Dossiers d'upload créés une seule fois (plus de makedirs par requête)
+    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+    os.makedirs(settings.ASYNC_UPLOAD_DIR, exist_ok=True)
+    
+    # Écriture groupée des last_login
+    last_login_flusher = asyncio.create_task(run_last_login_flusher())
+    
     yield
     
     logger.info("👋 Arrêt de l'application")
+    # Attendre la fin de l'annulation avant le flush final (pas de flush concurrent)
+    last_login_flusher.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await last_login_flusher
+    await flush_last_logins()
+    _stop_log_listener(log_listener, previous_log_handlers)
 
 # ========================================
 # APPLICATION FASTAPI
@@ -41,15 +86,50 @@ app = FastAPI(
     title="Bid-Killer Engine API",
     description="API d'analyse intelligente de DCE BTP",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse  # Sérialisation JSON via orjson (plus rapide que json stdlib)
 )
 
+# ========================================
+# COMPRESSION DES RÉPONSES
+# ========================================
+
+# Les résultats d'analyse (JSON Claude) font souvent 50-500 KB ; les exports DOCX sont déjà
+# des archives zip : recompresser ne gagne rien et ferait transiter le fichier par le middleware
+GZIP_CONTENT_TYPES = ("application/json", "text/")
+
+
+class _TextGZipResponder(GZipResponder):
+    """GZipResponder limité aux types texte/JSON, les autres réponses passent telles quelles"""
+    
+    async def send_with_gzip(self, message: Message) -> None:
+        await super().send_with_gzip(message)
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            if not content_type.startswith(GZIP_CONTENT_TYPES):
+                # Même chemin qu'une réponse déjà encodée : en-têtes et corps inchangés
+                self.content_encoding_set = True
+
+
+class TextGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware qui ne compresse que les réponses JSON / texte"""
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = _TextGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(TextGZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # ========================================
 # CONFIGURATION CORS RENFORCÉE
 # ========================================
 
-# Liste complète des origines autorisées
-ALLOWED_ORIGINS = [
+# Liste complète des origines autorisées (frozenset : test d'origine en O(1))
+ALLOWED_ORIGINS = frozenset({
     # Localhost (dev)
     "http://localhost:3000",
     "http://localhost:8080",
@@ -68,7 +148,7 @@ ALLOWED_ORIGINS = [
     "https://www.monsieurlanding.fr",
     "http://monsieurlanding.fr",
     "http://www.monsieurlanding.fr",
-]
+})
 
 app.add_middleware(
     CORSMiddleware,
@@ -76,8 +156,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Tous les méthodes (GET, POST, PUT, DELETE, OPTIONS)
     allow_headers=["*"],  # Tous les headers
-    expose_headers=["*"],  # Expose tous les headers dans la réponse
-    max_age=3600,  # Cache preflight pendant 1 heure
+    # "*" est invalide avec allow_credentials=True : exposer uniquement le nécessaire
+    expose_headers=["Content-Disposition"],  # Nom du fichier DOCX téléchargé
+    max_age=86400,  # Cache preflight 24h (plafonné par le navigateur)
 )
 
 # ========================================
@@ -112,20 +193,29 @@ app.include_router(export_routes.router, prefix="/api/export", tags=["Export"])
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     """Handler global pour les exceptions"""
-    logger.error(f"Erreur non gérée : {str(exc)}")
-    return {
-        "error": "Une erreur est survenue",
-        "detail": str(exc)
-    }
+    # Un seul enregistrement avec la stack trace complète
+    logger.exception(f"Erreur non gérée : {request.method} {request.url.path}")
+    return ORJSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content={
+            "error": "Une erreur est survenue",
+            "detail": str(exc)
+        }
+    )
 
 # ========================================
-# MIDDLEWARE DE LOGGING (optionnel)
+# MIDDLEWARE TAILLE MAX DES UPLOADS
 # ========================================
 
 @app.middleware("http")
-async def log_requests(request, call_next):
-    """Log toutes les requêtes"""
-    logger.info(f"📥 {request.method} {request.url.path} - Origin: {request.headers.get('origin', 'N/A')}")
-    response = await call_next(request)
-    logger.info(f"📤 Response status: {response.status_code}")
-    return response
+async def reject_oversized_uploads(request, call_next):
+    """Rejette les requêtes trop volumineuses d'après Content-Length, avant lecture du body"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > settings.MAX_UPLOAD_SIZE:
+        return ORJSONResponse(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            content={
+                "detail": f"Fichier trop volumineux. Taille max: {settings.MAX_UPLOAD_SIZE / 1024 / 1024 / 1024}GB"
+            }
+        )
+    return await call_next(request)
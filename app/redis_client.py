@@ -0,0 +1,29 @@
+"""
+Connexions Redis partagées
+Pools communs (file RQ, état des jobs, cache LLM) : un seul jeu de sockets par process
+"""
+
+from redis import Redis, ConnectionPool
+import os
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+
+# Pool partagé : évite de sérialiser toutes les opérations Redis sur un seul socket
+# Réponses brutes (bytes) : requis par RQ
+redis_pool = ConnectionPool.from_url(
+    REDIS_URL,
+    max_connections=50,
+    socket_keepalive=True,
+    health_check_interval=30
+)
+redis_conn = Redis(connection_pool=redis_pool)
+
+# Même serveur, réponses décodées en str (état des jobs, cache LLM)
+redis_text_pool = ConnectionPool.from_url(
+    REDIS_URL,
+    max_connections=50,
+    socket_keepalive=True,
+    health_check_interval=30,
+    decode_responses=True
+)
+redis_text_conn = Redis(connection_pool=redis_text_pool)
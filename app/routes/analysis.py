@@ -17,10 +17,13 @@ import time
 import uuid
 import tempfile
 import shutil
+import asyncio
+import hashlib
 from pathlib import Path
+import aiofiles
+import aiofiles.os
 
 # RENDER : Import RQ pour queue au lieu de BackgroundTasks
-from redis import Redis
 from rq import Queue
 
 from app.database import get_db, User, DCEAnalysis
@@ -28,6 +31,7 @@ from app.routes.auth import get_current_active_user
 from app.services.claude_service import claude_service
 from app.services.file_processor import UniversalFileProcessor
 from app.config import settings
+from app.redis_client import redis_conn
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -36,8 +40,6 @@ logger = logging.getLogger(__name__)
 # CONFIGURATION RQ (Redis Queue) - RENDER
 # ========================================
 
-redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
-redis_conn = Redis.from_url(redis_url)
 queue = Queue('default', connection=redis_conn)
 
 # ========================================
@@ -104,7 +106,7 @@ class JobStatusResponse(BaseModel):
 
 async def check_user_quota(user: User) -> bool:
     """Vérifie si l'utilisateur a encore du quota"""
-    return user.analyses_used < user.analyses_limit
+    return user.can_analyze
 
 
 async def increment_user_quota(user: User, db: AsyncSession):
@@ -113,6 +115,107 @@ async def increment_user_quota(user: User, db: AsyncSession):
     await db.commit()
 
 
+# Taille des blocs lus/écrits lors de la sauvegarde des uploads (4 MiB)
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _file_too_large(max_size: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f"Fichier trop volumineux. Taille max: {max_size / 1024 / 1024 / 1024}GB"
+    )
+
+
+def _copy_spooled_file(src, dest_path: str, max_size: Optional[int], hasher=None) -> int:
+    """
+    Copie le fichier temporaire de Starlette via sendfile(2) (copie noyau, sans passer par Python)
+    Avec hasher : copie par blocs en Python, chaque bloc est haché au passage (une seule lecture)
+    Exécuté dans un thread
+    """
+    # Force le passage sur disque (no-op si déjà fait, coût négligeable sous 1 MB)
+    src.rollover()
+    src_fd = src.fileno()
+    size = os.fstat(src_fd).st_size
+    
+    if max_size is not None and size > max_size:
+        raise _file_too_large(max_size)
+    
+    if hasher is not None:
+        written = 0
+        src.seek(0)
+        with open(dest_path, "wb") as dst:
+            while chunk := src.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                dst.write(chunk)
+                written += len(chunk)
+        return written
+    
+    offset = 0
+    with open(dest_path, "wb") as dst:
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src_fd, offset, min(UPLOAD_CHUNK_SIZE, size - offset))
+            if sent == 0:
+                break
+            offset += sent
+    
+    return offset
+
+
+async def save_upload_file(
+    file: UploadFile,
+    dest_path: str,
+    max_size: Optional[int] = None,
+    hasher=None
+) -> int:
+    """
+    Sauvegarde un upload sur disque par blocs (sans charger tout le fichier en RAM)
+    hasher (hashlib) optionnel : mis à jour pendant l'écriture, sans relire le fichier
+    Retourne le nombre d'octets écrits
+    """
+    # Taille déjà connue du parser multipart (UploadFile.size) : rejet sans copie
+    if max_size is not None and file.size is not None and file.size > max_size:
+        raise _file_too_large(max_size)
+    
+    written = 0
+    try:
+        # Chemin rapide : sendfile depuis le SpooledTemporaryFile de Starlette
+        if hasattr(os, "sendfile") and hasattr(file.file, "rollover"):
+            return await asyncio.to_thread(_copy_spooled_file, file.file, dest_path, max_size, hasher)
+        
+        async with aiofiles.open(dest_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                written += len(chunk)
+                if max_size is not None and written > max_size:
+                    raise _file_too_large(max_size)
+                if hasher is not None:
+                    hasher.update(chunk)
+                await buffer.write(chunk)
+    except Exception:
+        # Ne pas laisser de fichier partiel sur le disque
+        if await aiofiles.os.path.exists(dest_path):
+            await aiofiles.os.remove(dest_path)
+        raise
+    
+    return written
+
+
+async def find_cached_analysis(
+    content_hash: str,
+    user_id: int,
+    db: AsyncSession
+) -> Optional[DCEAnalysis]:
+    """Cherche une analyse terminée du même fichier (même contenu) pour cet utilisateur"""
+    result = await db.execute(
+        select(DCEAnalysis)
+        .where(DCEAnalysis.content_hash == content_hash)
+        .where(DCEAnalysis.user_id == user_id)
+        .where(DCEAnalysis.status == "completed")
+        .order_by(desc(DCEAnalysis.created_at))
+        .limit(1)
+    )
+    return result.scalar_one_or_none()
+
+
 # ========================================
 # ROUTES SYNCHRONES (EXISTANTES - POUR PETITS DCE)
 # ========================================
@@ -129,6 +232,16 @@ async def _analyze_dce_impl(
     
     start_time = time.time()
     
+    file_ext = Path(file.filename).suffix.lower()
+    
+    # Rejeter les formats non supportés AVANT toute copie du fichier
+    if file_ext not in settings.ALLOWED_EXTENSIONS:
+        logger.warning(f"⚠️ Format non supporté : {file_ext}")
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Format non supporté : {file_ext or 'inconnu'}"
+        )
+    
     # Vérifier le quota
     if not await check_user_quota(current_user):
         raise HTTPException(
@@ -136,52 +249,65 @@ async def _analyze_dce_impl(
             detail=f"Quota d'analyses épuisé ({current_user.analyses_limit} analyses/mois). Veuillez upgrader votre abonnement."
         )
     
-    file_ext = os.path.splitext(file.filename)[1].lower()
+    MAX_SIZE = settings.MAX_UPLOAD_SIZE  # 5 GB
     
-    # Liste étendue des formats acceptés
-    SUPPORTED_FORMATS = [
-        '.pdf', '.docx', '.doc', '.txt', '.md', '.rtf',
-        '.zip', '.7z', '.rar', '.tar', '.gz', '.tgz', '.bz2',
-        '.xlsx', '.xls', '.csv'
-    ]
-    
-    if file_ext not in SUPPORTED_FORMATS:
-        logger.warning(f"⚠️ Format potentiellement non supporté : {file_ext}")
-    
-    # Vérifier la taille du fichier (5 GB max)
-    file.file.seek(0, 2)
-    file_size = file.file.tell()
-    file.file.seek(0)
+    # Sauvegarder le fichier (dossier créé au démarrage, cf. lifespan)
+    file_path = os.path.join(
+        settings.UPLOAD_DIR,
+        f"{current_user.id}_{time.time_ns()}_{file.filename}"
+    )
     
-    MAX_SIZE = 5 * 1024 * 1024 * 1024  # 5 GB
+    logger.debug(f"💾 Sauvegarde du fichier : {file_path}")
     
-    if file_size > MAX_SIZE:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Fichier trop volumineux. Taille max: {MAX_SIZE / 1024 / 1024 / 1024}GB"
-        )
+    # Sauvegarde en streaming + vérification de la taille (5 GB max)
+    # Empreinte BLAKE2b-256 calculée pendant l'écriture (cache d'analyse par contenu)
+    content_hasher = hashlib.blake2b(digest_size=32)
+    file_size = await save_upload_file(file, file_path, max_size=MAX_SIZE, hasher=content_hasher)
     
     # Log de la taille pour tracking
     file_size_mb = file_size / 1024 / 1024
-    logger.info(f"📁 Fichier reçu : {file.filename} ({file_size_mb:.2f} MB)")
-    
-    # Créer le dossier d'upload si nécessaire
-    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
-    
-    # Sauvegarder le fichier
-    file_path = os.path.join(
-        settings.UPLOAD_DIR,
-        f"{current_user.id}_{datetime.utcnow().timestamp()}_{file.filename}"
-    )
+    logger.debug(f"📁 Fichier reçu : {file.filename} ({file_size_mb:.2f} MB)")
     
-    logger.info(f"💾 Sauvegarde du fichier : {file_path}")
+    save_time = time.time() - start_time
+    logger.debug(f"✅ Fichier sauvegardé en {save_time:.2f}s")
     
-    with open(file_path, "wb") as buffer:
-        content = await file.read()
-        buffer.write(content)
+    # Empreinte du contenu : un DCE déjà analysé ne repasse pas par Claude
+    content_hash = content_hasher.hexdigest()
+    cached = await find_cached_analysis(content_hash, current_user.id, db)
     
-    save_time = time.time() - start_time
-    logger.info(f"✅ Fichier sauvegardé en {save_time:.2f}s")
+    if cached:
+        logger.info(f"♻️ DCE déjà analysé (analyse {cached.id}) - réutilisation du résultat")
+        
+        analysis = DCEAnalysis(
+            user_id=current_user.id,
+            file_name=file.filename,
+            file_size=file_size,
+            file_type=file_ext,
+            content_hash=content_hash,
+            status="completed",
+            analysis_result=cached.analysis_result,
+            project_name=cached.project_name,
+            client_name=cached.client_name,
+            budget_ht=cached.budget_ht,
+            deadline=cached.deadline,
+            completed_at=datetime.utcnow()
+        )
+        db.add(analysis)
+        
+        # Le quota reste décompté : c'est une analyse livrée à l'utilisateur
+        await increment_user_quota(current_user, db)
+        
+        return AnalysisResponse(
+            id=analysis.id,
+            status=analysis.status,
+            result=analysis.analysis_result,
+            project_name=analysis.project_name,
+            client_name=analysis.client_name,
+            budget_ht=analysis.budget_ht,
+            deadline=analysis.deadline,
+            created_at=analysis.created_at,
+            completed_at=analysis.completed_at
+        )
     
     # Créer l'entrée d'analyse
     analysis = DCEAnalysis(
@@ -189,14 +315,15 @@ async def _analyze_dce_impl(
         file_name=file.filename,
         file_size=file_size,
         file_type=file_ext,
+        content_hash=content_hash,
         status="processing"
     )
     
+    # INSERT ... RETURNING id, created_at (eager_defaults) : pas de SELECT de refresh
     db.add(analysis)
     await db.commit()
-    await db.refresh(analysis)
     
-    logger.info(f"📊 Analyse créée : ID {analysis.id}")
+    logger.debug(f"📊 Analyse créée : ID {analysis.id}")
     
     # Lancer l'analyse
     try:
@@ -205,7 +332,7 @@ async def _analyze_dce_impl(
         # ========================================
         
         extraction_start = time.time()
-        logger.info(f"🚀 Lancement extraction pour {file.filename}")
+        logger.debug(f"🚀 Lancement extraction pour {file.filename}")
         
         processor = UniversalFileProcessor()
         extraction_result = await processor.process_file(file_path, file.filename)
@@ -220,7 +347,7 @@ async def _analyze_dce_impl(
         extracted_text = extraction_result['extracted_text']
         files_processed = extraction_result['files_processed']
         
-        logger.info(
+        logger.debug(
             f"✅ Extraction réussie en {extraction_time:.2f}s : "
             f"{files_processed} fichier(s), {len(extracted_text)} caractères"
         )
@@ -241,17 +368,17 @@ async def _analyze_dce_impl(
         # ========================================
         
         analysis_start = time.time()
-        logger.info("🤖 Lancement analyse Claude AI...")
+        logger.debug("🤖 Lancement analyse Claude AI...")
         
         # Log de la longueur du texte
         text_length = len(extracted_text)
         estimated_tokens = text_length / 4  # Rough estimation
-        logger.info(f"📝 Texte à analyser : {text_length} caractères (~{int(estimated_tokens)} tokens)")
+        logger.debug(f"📝 Texte à analyser : {text_length} caractères (~{int(estimated_tokens)} tokens)")
         
         analysis_result = await claude_service.analyze_dce(extracted_text)
         
         analysis_time = time.time() - analysis_start
-        logger.info(f"✅ Analyse Claude terminée en {analysis_time:.2f}s")
+        logger.debug(f"✅ Analyse Claude terminée en {analysis_time:.2f}s")
         
         # Mettre à jour l'analyse
         analysis.status = "completed"
@@ -277,15 +404,22 @@ async def _analyze_dce_impl(
         await increment_user_quota(current_user, db)
         
         await db.commit()
-        await db.refresh(analysis)
         
-        total_time = time.time() - start_time
+        # Un seul événement structuré pour toute la requête (étapes intermédiaires en DEBUG)
+        timings = {
+            "total": round(time.time() - start_time, 2),
+            "save": round(save_time, 2),
+            "extraction": round(extraction_time, 2),
+            "analysis": round(analysis_time, 2)
+        }
         logger.info(
-            f"🎉 Analyse terminée avec succès : ID {analysis.id}\n"
-            f"   Temps total : {total_time:.2f}s\n"
-            f"   - Sauvegarde : {save_time:.2f}s\n"
-            f"   - Extraction : {extraction_time:.2f}s ({files_processed} fichiers)\n"
-            f"   - Analyse : {analysis_time:.2f}s"
+            f"🎉 Analyse terminée : ID {analysis.id} - {file_size_mb:.2f} MB, "
+            f"{files_processed} fichier(s), {text_length} caractères - timings {timings}",
+            extra={
+                "analysis_id": analysis.id,
+                "files_processed": files_processed,
+                "timings": timings
+            }
         )
         
     except Exception as e:
@@ -296,7 +430,6 @@ async def _analyze_dce_impl(
         analysis.status = "failed"
         analysis.error_message = str(e)
         await db.commit()
-        await db.refresh(analysis)
     
     finally:
         # Optionnel : Nettoyer le fichier uploadé
@@ -357,8 +490,18 @@ async def get_analysis_history(
 ):
     """Récupère l'historique des analyses"""
     
+    # Projection : on ne charge pas le JSON complet (analysis_result) pour la liste
     result = await db.execute(
-        select(DCEAnalysis)
+        select(
+            DCEAnalysis.id,
+            DCEAnalysis.status,
+            DCEAnalysis.project_name,
+            DCEAnalysis.client_name,
+            DCEAnalysis.budget_ht,
+            DCEAnalysis.deadline,
+            DCEAnalysis.created_at,
+            DCEAnalysis.completed_at
+        )
         .where(DCEAnalysis.user_id == current_user.id)
         .where(DCEAnalysis.is_archived == False)
         .order_by(desc(DCEAnalysis.created_at))
@@ -366,13 +509,13 @@ async def get_analysis_history(
         .offset(offset)
     )
     
-    analyses = result.scalars().all()
+    analyses = result.all()
     
     return [
         AnalysisResponse(
             id=a.id,
             status=a.status,
-            result=a.analysis_result,
+            result=None,  # Détail complet via GET /{analysis_id}
             project_name=a.project_name,
             client_name=a.client_name,
             budget_ht=a.budget_ht,
@@ -487,15 +630,11 @@ async def analyze_dce_async(
     
     logger.info(f"📋 Nouvelle analyse async - Job {job_id} - Fichier: {file.filename}")
     
-    # Sauvegarder fichier temporairement
-    os.makedirs('/tmp/uploads', exist_ok=True)
-    
+    # Sauvegarder fichier temporairement (dossier créé au démarrage, cf. lifespan)
     suffix = Path(file.filename).suffix
-    temp_path = f'/tmp/uploads/{job_id}{suffix}'
+    temp_path = os.path.join(settings.ASYNC_UPLOAD_DIR, f'{job_id}{suffix}')
     
-    with open(temp_path, 'wb') as f:
-        content = await file.read()
-        f.write(content)
+    await save_upload_file(file, temp_path)
     
     logger.info(f"💾 Fichier sauvegardé temporairement : {temp_path}")
     
@@ -509,7 +648,9 @@ async def analyze_dce_async(
     # RENDER : Enqueue dans Redis Queue (RQ) pour Worker
     # Le worker prendra ce job et le traitera sans timeout
     try:
-        job = queue.enqueue(
+        # enqueue est synchrone : exécuté dans un thread pour ne pas bloquer l'event loop
+        job = await asyncio.to_thread(
+            queue.enqueue,
             'worker.process_analysis_job',  # Fonction dans worker.py
             args=(job_id, temp_path, file.filename, current_user.id),  # ✅ Arguments positionnels
             job_timeout='2h',  # Timeout de 2 heures (largement suffisant)
@@ -522,8 +663,8 @@ async def analyze_dce_async(
     except Exception as e:
         logger.error(f"❌ Erreur enqueue job {job_id}: {e}")
         # Nettoyer fichier temporaire
-        if os.path.exists(temp_path):
-            os.unlink(temp_path)
+        if await aiofiles.os.path.exists(temp_path):
+            await aiofiles.os.remove(temp_path)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Erreur lors de la mise en queue : {str(e)}"
@@ -3,17 +3,23 @@ Routes d'authentification
 Inscription, connexion, JWT tokens
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from pydantic import BaseModel, EmailStr
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+import bcrypt
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import jwt
+from jwt import InvalidTokenError as JWTError
 from datetime import datetime, timedelta
 from typing import Optional
 
-from app.database import get_db, User
+from app.database import get_db, User, touch_last_login, touch_password_hash
 from app.config import settings
 
 router = APIRouter()
@@ -22,7 +28,6 @@ router = APIRouter()
 # SECURITY
 # ========================================
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
 # ========================================
@@ -53,6 +58,16 @@ class UserResponse(BaseModel):
         from_attributes = True
 
 
+def to_user_response(user: User) -> UserResponse:
+    """
+    Construit UserResponse sans revalidation (model_construct)
+    Les données viennent de la DB et sont déjà typées
+    """
+    return UserResponse.model_construct(
+        **{field: getattr(user, field) for field in UserResponse.model_fields}
+    )
+
+
 class Token(BaseModel):
     """Token JWT"""
     access_token: str
@@ -64,66 +79,137 @@ class Token(BaseModel):
 # PASSWORD UTILS
 # ========================================
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+# bcrypt appelé directement (backend Rust de bcrypt>=4), sans l'indirection passlib
+# Les hashes $2b$ existants générés par passlib restent compatibles
+
+# bcrypt libère le GIL : exécuté dans un pool dédié pour ne pas bloquer l'event loop
+_BCRYPT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="bcrypt")
+
+
+def _verify_password_sync(plain_password: str, hashed_password: str) -> bool:
+    try:
+        return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+    except ValueError:
+        # Hash invalide / mal formé
+        return False
+
+
+def _hash_password_sync(password: str, rounds: int = settings.BCRYPT_ROUNDS) -> str:
+    salt = bcrypt.gensalt(rounds=rounds)
+    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Vérifie un mot de passe"""
-    return pwd_context.verify(plain_password, hashed_password)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_BCRYPT_POOL, _verify_password_sync, plain_password, hashed_password)
+
+
+# Coût des hashes existants avant BCRYPT_ROUNDS : un coût abaissé ne les migre pas
+# (password_needs_rehash ne fait que relever le coût)
+LEGACY_BCRYPT_ROUNDS = 12
 
+# Hash factice vérifié quand l'email est inconnu : le login répond alors dans le même temps
+# qu'un mauvais mot de passe, pas d'énumération des comptes par timing. Coût = le plus élevé
+# pouvant exister en base, sinon les anciens comptes répondraient plus lentement
+_DUMMY_PASSWORD_HASH = _hash_password_sync(
+    os.urandom(16).hex(), rounds=max(LEGACY_BCRYPT_ROUNDS, settings.BCRYPT_ROUNDS)
+)
 
-def get_password_hash(password: str) -> str:
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """Vrai si le hash a un coût inférieur à BCRYPT_ROUNDS (format $2b$12$...) ; jamais abaissé"""
+    try:
+        return int(hashed_password.split("$")[2]) < settings.BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+
+async def get_password_hash(password: str) -> str:
     """Hash un mot de passe"""
-    return pwd_context.hash(password)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_BCRYPT_POOL, _hash_password_sync, password)
+
+
+async def _rehash_password(user_id: int, current_hash: str, password: str):
+    """Re-hash au coût courant après la réponse ; l'UPDATE part avec le flush groupé des last_login"""
+    touch_password_hash(user_id, current_hash, await get_password_hash(password))
 
 
 # ========================================
 # JWT UTILS
 # ========================================
 
+# Durée de validité par défaut, calculée une seule fois
+_DEFAULT_TOKEN_TTL_SECONDS = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES).total_seconds()
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Crée un JWT token"""
     to_encode = data.copy()
     
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    
-    to_encode.update({"exp": expire})
+    # exp = timestamp Unix (entier), sans arithmétique datetime
+    ttl_seconds = expires_delta.total_seconds() if expires_delta else _DEFAULT_TOKEN_TTL_SECONDS
+    to_encode["exp"] = int(time.time() + ttl_seconds)
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     
     return encoded_jwt
 
 
-async def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    db: AsyncSession = Depends(get_db)
-) -> User:
-    """Récupère l'utilisateur courant depuis le JWT"""
-    credentials_exception = HTTPException(
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Impossible de valider les credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    
+
+
+def _decode_token_email(token: str) -> str:
+    """Email (sub) du JWT, sans accès base"""
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
+        raise _credentials_exception()
+    if email is None:
+        raise _credentials_exception()
+    return email
+
+
+async def _authenticate(token: str, db: AsyncSession) -> User:
+    """Résout l'utilisateur depuis le JWT (appel direct, hors graphe de dépendances)"""
+    email = _decode_token_email(token)
     
     # Récupérer l'utilisateur depuis la DB
     result = await db.execute(select(User).where(User.email == email))
     user = result.scalar_one_or_none()
     
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
     
     return user
 
 
-async def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
-    """Vérifie que l'utilisateur est actif"""
+async def get_current_user_email(token: str = Depends(oauth2_scheme)) -> str:
+    """Email de l'utilisateur courant (JWT seul) : la route choisit les colonnes à lire"""
+    return _decode_token_email(token)
+
+
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_db)
+) -> User:
+    """Récupère l'utilisateur courant depuis le JWT"""
+    return await _authenticate(token, db)
+
+
+async def get_current_active_user(
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_db)
+) -> User:
+    """Récupère l'utilisateur courant et vérifie qu'il est actif"""
+    # Appel direct plutôt que Depends(get_current_user) : un niveau de résolution en moins
+    current_user = await _authenticate(token, db)
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Utilisateur inactif")
     return current_user
@@ -138,33 +224,37 @@ async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     """
     Inscription d'un nouvel utilisateur
     """
-    # Vérifier si l'email existe déjà
-    result = await db.execute(select(User).where(User.email == user_data.email))
-    existing_user = result.scalar_one_or_none()
+    # Emails normalisés en minuscules (index ix_users_email_lower)
+    email = user_data.email.lower()
+    
+    # Créer le nouvel utilisateur
+    hashed_password = await get_password_hash(user_data.password)
+    
+    # INSERT ... ON CONFLICT DO NOTHING RETURNING : test d'unicité + création + relecture
+    # en un seul aller-retour (et sans course entre deux inscriptions simultanées)
+    new_user = await db.scalar(
+        pg_insert(User)
+        .values(
+            email=email,
+            hashed_password=hashed_password,
+            full_name=user_data.full_name,
+            company_name=user_data.company_name,
+            subscription_tier="free",
+            subscription_status="inactive",
+            analyses_limit=0,
+            analyses_used=0
+        )
+        .on_conflict_do_nothing()
+        .returning(User)
+    )
     
-    if existing_user:
+    if new_user is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email déjà enregistré"
         )
     
-    # Créer le nouvel utilisateur
-    hashed_password = get_password_hash(user_data.password)
-    
-    new_user = User(
-        email=user_data.email,
-        hashed_password=hashed_password,
-        full_name=user_data.full_name,
-        company_name=user_data.company_name,
-        subscription_tier="free",
-        subscription_status="inactive",
-        analyses_limit=0,
-        analyses_used=0
-    )
-    
-    db.add(new_user)
     await db.commit()
-    await db.refresh(new_user)
     
     # Créer le JWT token
     access_token = create_access_token(data={"sub": new_user.email})
@@ -172,12 +262,13 @@ async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     return {
         "access_token": access_token,
         "token_type": "bearer",
-        "user": UserResponse.from_orm(new_user)
+        "user": to_user_response(new_user)
     }
 
 
 @router.post("/login", response_model=Token)
 async def login(
+    background_tasks: BackgroundTasks,
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: AsyncSession = Depends(get_db)
 ):
@@ -185,10 +276,15 @@ async def login(
     Connexion utilisateur
     """
     # Récupérer l'utilisateur
-    result = await db.execute(select(User).where(User.email == form_data.username))
+    result = await db.execute(
+        select(User).where(func.lower(User.email) == form_data.username.lower())
+    )
     user = result.scalar_one_or_none()
     
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not user:
+        await verify_password(form_data.password, _DUMMY_PASSWORD_HASH)
+    
+    if not user or not await verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email ou mot de passe incorrect",
@@ -201,9 +297,13 @@ async def login(
             detail="Compte désactivé"
         )
     
-    # Mettre à jour last_login
-    user.last_login = datetime.utcnow()
-    await db.commit()
+    # Coût bcrypt relevé (BCRYPT_ROUNDS) : re-hash transparent, le mot de passe en clair
+    # n'est disponible qu'ici ; bcrypt après la réponse, écriture groupée hors session requête
+    if password_needs_rehash(user.hashed_password):
+        background_tasks.add_task(_rehash_password, user.id, user.hashed_password, form_data.password)
+    
+    # Mettre à jour last_login (écriture groupée en tâche de fond, hors chemin critique)
+    touch_last_login(user.id)
     
     # Créer le JWT token
     access_token = create_access_token(data={"sub": user.email})
@@ -211,7 +311,7 @@ async def login(
     return {
         "access_token": access_token,
         "token_type": "bearer",
-        "user": UserResponse.from_orm(user)
+        "user": to_user_response(user)
     }
 
 
@@ -220,7 +320,7 @@ async def read_users_me(current_user: User = Depends(get_current_active_user)):
     """
     Récupère les infos de l'utilisateur connecté
     """
-    return UserResponse.from_orm(current_user)
+    return to_user_response(current_user)
 
 
 @router.post("/refresh-token", response_model=Token)
@@ -233,5 +333,5 @@ async def refresh_token(current_user: User = Depends(get_current_active_user)):
     return {
         "access_token": access_token,
         "token_type": "bearer",
-        "user": UserResponse.from_orm(current_user)
+        "user": to_user_response(current_user)
     }
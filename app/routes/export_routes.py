@@ -12,39 +12,130 @@ NOUVEAU :
 """
 
 from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
+from starlette.background import BackgroundTask
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, and_
 from docx import Document
 from docx.shared import Inches, Pt, RGBColor
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.enum.style import WD_STYLE_TYPE
 from docx.oxml.ns import qn
 from docx.oxml import OxmlElement
+import io
 import os
 import re
+import copy
+import orjson
+import asyncio
+import hashlib
+import threading
+from bisect import bisect_right
+from urllib.parse import quote
 from datetime import datetime
 from typing import List, Dict, Any, Optional, Tuple
 from collections import Counter
+from functools import lru_cache
 import anthropic
+from redis import RedisError
+from redis.asyncio import Redis as AsyncRedis
 
 from app.database import get_db, User, DCEAnalysis, GeneratedDocument
 from app.routes.auth import get_current_active_user
 from app.config import settings
+from app.redis_client import REDIS_URL, redis_text_conn
 
 router = APIRouter()
 
+# ========================================
+# CACHE DES RÉPONSES CLAUDE (clé = hash du prompt)
+# ========================================
+
+# Redis plutôt qu'un cache disque : partagé entre instances, disque éphémère sur Render
+LLM_CACHE_TTL_SECONDS = 30 * 86400
+
+_llm_cache = redis_text_conn
+_llm_cache_async = AsyncRedis.from_url(REDIS_URL, decode_responses=True)
+
+
+def _llm_cache_key(model: str, prompt: str) -> str:
+    """Clé de cache adressée par contenu (modèle + prompt)"""
+    digest = hashlib.blake2b(f"{model}\0{prompt}".encode(), digest_size=32).hexdigest()
+    return f"llm:{digest}"
+
+
+def _llm_cache_get(key: str) -> Optional[Any]:
+    try:
+        cached = _llm_cache.get(key)
+    except RedisError:
+        return None  # Cache indisponible → appel Claude normal
+    return orjson.loads(cached) if cached is not None else None
+
+
+def _llm_cache_set(key: str, value: Any) -> None:
+    try:
+        _llm_cache.set(key, orjson.dumps(value), ex=LLM_CACHE_TTL_SECONDS)
+    except RedisError:
+        pass
+
+
+async def _llm_cache_get_async(key: str) -> Optional[Any]:
+    try:
+        cached = await _llm_cache_async.get(key)
+    except RedisError:
+        return None
+    return orjson.loads(cached) if cached is not None else None
+
+
+async def _llm_cache_set_async(key: str, value: Any) -> None:
+    try:
+        await _llm_cache_async.set(key, orjson.dumps(value), ex=LLM_CACHE_TTL_SECONDS)
+    except RedisError:
+        pass
+
+
 # ========================================
 # SYSTÈME DE GÉNÉRATION DYNAMIQUE VIA CLAUDE AI
 # ========================================
 
+# Balises ```json / ``` entourant parfois la réponse JSON de Claude
+_MARKDOWN_FENCE_RE = re.compile(r'```(?:json)?\n?')
+
+
 class AIContentGenerator:
     """Génère du contenu intelligent via Claude AI"""
     
+    # Nombre max d'appels Claude simultanés pour la génération des lots
+    MAX_CONCURRENT_REQUESTS = 8
+    
     def __init__(self):
         self.client = anthropic.Anthropic(api_key=settings.ANTHROPIC_API_KEY)
+        self.async_client = anthropic.AsyncAnthropic(api_key=settings.ANTHROPIC_API_KEY)
         self.model = "claude-sonnet-4-20250514"
     
-    def generate_lot_description(
+    async def generate_lot_descriptions_batch(
+        self,
+        lots: List[Dict[str, Any]],
+        project_context: str
+    ) -> List[Dict[str, str]]:
+        """
+        Génère les descriptions de plusieurs lots en parallèle
+        Durée totale ≈ appel le plus long (au lieu de la somme des appels)
+        """
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+        
+        async def _generate(lot: Dict[str, Any]) -> Dict[str, str]:
+            async with semaphore:
+                return await self.generate_lot_description(
+                    lot_name=lot.get('name', ''),
+                    lot_number=lot.get('number', 'XX'),
+                    project_context=project_context,
+                    existing_content=lot.get('description', '')
+                )
+        
+        return await asyncio.gather(*(_generate(lot) for lot in lots))
+    
+    async def generate_lot_description(
         self, 
         lot_name: str, 
         lot_number: str,
@@ -84,8 +175,14 @@ FORMAT DE RÉPONSE (JSON strict) :
 
 Réponds UNIQUEMENT avec le JSON, sans texte avant/après."""
 
+        # Prompt déjà traité (ré-export du même DCE) → pas d'appel Claude
+        cache_key = _llm_cache_key(self.model, prompt)
+        cached = await _llm_cache_get_async(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
-            response = self.client.messages.create(
+            response = await self.async_client.messages.create(
                 model=self.model,
                 max_tokens=1000,
                 messages=[{"role": "user", "content": prompt}]
@@ -93,13 +190,11 @@ Réponds UNIQUEMENT avec le JSON, sans texte avant/après."""
             
             content = response.content[0].text.strip()
             
-            # Parser le JSON
-            import json
-            # Nettoyer les balises markdown si présentes
-            content = re.sub(r'```json\n?', '', content)
-            content = re.sub(r'```\n?', '', content)
+            # Nettoyer les balises markdown si présentes, puis parser le JSON
+            content = _MARKDOWN_FENCE_RE.sub('', content)
             
-            result = json.loads(content)
+            result = orjson.loads(content)
+            await _llm_cache_set_async(cache_key, result)
             return result
             
         except Exception as e:
@@ -118,9 +213,10 @@ Réponds UNIQUEMENT avec le JSON, sans texte avant/après."""
         self,
         risk_description: str,
         project_context: str
-    ) -> str:
+    ) -> Optional[str]:
         """
         Génère une solution pour un risque inconnu via Claude AI
+        Retourne None si l'API échoue (l'appelant applique son fallback)
         """
         
         prompt = f"""Tu es un expert BTP spécialisé en gestion des risques.
@@ -146,6 +242,11 @@ Solution : "Intervention hors période de reproduction (mai-août), obtention d
 
 Réponds UNIQUEMENT avec la phrase solution, sans intro ni explication."""
 
+        cache_key = _llm_cache_key(self.model, prompt)
+        cached = _llm_cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
             response = self.client.messages.create(
                 model=self.model,
@@ -156,16 +257,146 @@ Réponds UNIQUEMENT avec la phrase solution, sans intro ni explication."""
             solution = response.content[0].text.strip()
             # Nettoyer et limiter
             solution = solution.replace('\n', ' ')[:250]
+            _llm_cache_set(cache_key, solution)
             return solution
             
-        except Exception as e:
-            return "Mise en œuvre de mesures adaptées selon les prescriptions du CCTP et consultation des organismes compétents."
+        except (anthropic.APIError, IndexError) as e:
+            # Erreur API / timeout / réponse vide
+            return None
 
 
 # ========================================
 # ALGORITHME 1 AMÉLIORÉ : DÉTECTION SÉMANTIQUE DES LOTS
 # ========================================
 
+# Patterns compilés une seule fois (statiques) ou mis en cache par numéro de lot (dynamiques)
+# Noms de lots fantômes : une seule alternance compilée (un seul appel au moteur C par nom)
+_GHOST_LOT_RE = re.compile('|'.join(f'(?:{pattern})' for pattern in [
+    r'^Lot\s*\d+$',
+    r'^Lot\s*\d+\s*-\s*Lot\s*\d+$',
+    r'^Lot\s*\d+\s*-\s*$',
+    r'^Non\s*spécifié$',
+    r'^À\s*(définir|préciser)$',
+    r'^Détails\s*à\s*préciser$',
+    r'^N/A$',
+    r'^TBD$',  # To Be Determined (anglais)
+    r'^TBC$'   # To Be Confirmed (anglais)
+]), re.IGNORECASE)
+
+_SEPARATORS_RE = re.compile(r'[-_]+')
+_FILENAME_NOISE_RE = re.compile(r'\b(CCTP|DCE|PDF|DOC|Trade|Package)\b', re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r'\s+')
+_LOT_PREFIX_RE = re.compile(r'^Lot\s*\d+')
+
+
+@lru_cache(maxsize=256)
+def _filename_regexes(lot_number: str) -> Tuple[re.Pattern, ...]:
+    """Patterns de noms de fichiers pour un numéro de lot"""
+    lot_number = re.escape(lot_number)
+    patterns = [
+        # Patterns français
+        rf'{lot_number}[-_\s]+(.+?)\.pdf',
+        rf'Lot[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf',
+        rf'CCTP[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf',
+        rf'{lot_number}[-_\s]*(.+?)\.pdf',
+        # Patterns anglais
+        rf'Trade[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf',
+        rf'Package[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf',
+        rf'Work[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf'
+    ]
+    return tuple(re.compile(pattern, re.IGNORECASE) for pattern in patterns)
+
+
+@lru_cache(maxsize=256)
+def _lot_title_regex(lot_number: str) -> re.Pattern:
+    """Pattern "Lot XX - Nom" pour un numéro de lot"""
+    return re.compile(rf'Lot\s*{re.escape(lot_number)}\s*[-:]\s*([^\n]+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=256)
+def _lot_context_regex(lot_number: str) -> re.Pattern:
+    """Pattern du contexte (±200 caractères) autour de "Lot XX" """
+    return re.compile(rf'.{{0,200}}Lot\s*{re.escape(lot_number)}.{{0,200}}', re.IGNORECASE)
+
+
+@lru_cache(maxsize=256)
+def _lot_mention_regex(lot_number: str) -> re.Pattern:
+    """Pattern de la simple mention "Lot XX" (sans contexte)"""
+    return re.compile(rf'Lot\s*{re.escape(lot_number)}', re.IGNORECASE)
+
+
+def _lot_context_windows(lot_number: str, full_text: str) -> List[str]:
+    """
+    Équivalent de _lot_context_regex(lot_number).findall(full_text) en temps linéaire
+    
+    Le préfixe .{0,200} fait retenter la regex à chaque position du texte (jusqu'à
+    200 retours arrière chacune). On cherche plutôt la mention "Lot XX" suivante,
+    on en déduit la position de départ que findall aurait retenue (au plus 200
+    caractères avant, sans franchir de saut de ligne ni la fin du match précédent)
+    et on n'applique la regex de contexte qu'à cette position.
+    """
+    mention_re = _lot_mention_regex(lot_number)
+    context_re = _lot_context_regex(lot_number)
+    
+    windows = []
+    pos = 0
+    while True:
+        mention = mention_re.search(full_text, pos)
+        if not mention:
+            return windows
+        mention_start = mention.start()
+        start = max(pos, mention_start - 200, full_text.rfind('\n', pos, mention_start) + 1)
+        window = context_re.match(full_text, start)
+        windows.append(window.group(0))
+        pos = window.end()
+
+
+def _build_keyword_scanner(
+    keywords_by_category: Dict[str, List[str]]
+) -> Tuple[re.Pattern, Dict[str, Tuple[str, ...]]]:
+    """
+    Compile une table catégorie → mots-clés en un seul automate (regex en alternance)
+    Une seule passe sur le texte remplace un str.count()/`in` par mot-clé
+    
+    Retourne (pattern, credits) : pour chaque mot-clé trouvé, les catégories à créditer
+    (y compris celles des mots-clés qui en sont un préfixe, ex. "roof" dans "roofing")
+    """
+    owners: Dict[str, List[str]] = {}
+    for category, keywords in keywords_by_category.items():
+        for keyword in keywords:
+            owners.setdefault(keyword, []).append(category)
+    
+    # Lookahead : toutes les positions sont testées (occurrences chevauchantes incluses),
+    # le mot-clé le plus long l'emporte à une position donnée
+    alternation = '|'.join(re.escape(kw) for kw in sorted(owners, key=len, reverse=True))
+    pattern = re.compile(f'(?=({alternation}))')
+    
+    credits = {
+        keyword: tuple(
+            category
+            for prefix, categories in owners.items() if keyword.startswith(prefix)
+            for category in categories
+        )
+        for keyword in owners
+    }
+    return pattern, credits
+
+
+def _scan_keywords(
+    text: str,
+    scanner: Tuple[re.Pattern, Dict[str, Tuple[str, ...]]]
+) -> Counter:
+    """Compte les occurrences de mots-clés par catégorie en une passe"""
+    pattern, credits = scanner
+    counts = Counter()
+    # findall + Counter sont implémentés en C : la boucle Python ne porte que sur
+    # les mots-clés distincts trouvés, pas sur chaque occurrence
+    for keyword, occurrences in Counter(pattern.findall(text)).items():
+        for category in credits[keyword]:
+            counts[category] += occurrences
+    return counts
+
+
 class AdvancedLotDetector:
     """Détection avancée des lots par analyse sémantique"""
     
@@ -215,6 +446,17 @@ class AdvancedLotDetector:
         }
     }
     
+    # Nom de lot par catégorie (inférence)
+    CATEGORY_NAMES = {
+        'structure': 'Gros Œuvre / Structural Works',
+        'roofing': 'Charpente Couverture / Roofing',
+        'joinery': 'Menuiseries / Joinery',
+        'plumbing': 'Plomberie Sanitaire / Plumbing',
+        'electrical': 'Électricité / Electrical',
+        'vrd': 'VRD Aménagements Extérieurs / Site Works',
+        'finishes': 'Revêtements Finitions / Finishes'
+    }
+    
     @staticmethod
     def is_ghost_lot(lot_name: str) -> bool:
         """Détecte si un lot est fantôme (amélioré)"""
@@ -222,52 +464,20 @@ class AdvancedLotDetector:
             return True
         
         # Patterns génériques
-        generic_patterns = [
-            r'^Lot\s*\d+$',
-            r'^Lot\s*\d+\s*-\s*Lot\s*\d+$',
-            r'^Lot\s*\d+\s*-\s*$',
-            r'^Non\s*spécifié$',
-            r'^À\s*(définir|préciser)$',
-            r'^Détails\s*à\s*préciser$',
-            r'^N/A$',
-            r'^TBD$',  # To Be Determined (anglais)
-            r'^TBC$'   # To Be Confirmed (anglais)
-        ]
-        
-        for pattern in generic_patterns:
-            if re.match(pattern, lot_name.strip(), re.IGNORECASE):
-                return True
-        
-        return False
+        name = lot_name.strip()
+        return _GHOST_LOT_RE.match(name) is not None
     
     @staticmethod
     def extract_lot_from_filename(filename: str, lot_number: str) -> Optional[str]:
         """Extraction améliorée depuis nom de fichier"""
         
-        # Patterns français
-        patterns_fr = [
-            rf'{lot_number}[-_\s]+(.+?)\.pdf',
-            rf'Lot[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf',
-            rf'CCTP[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf',
-            rf'{lot_number}[-_\s]*(.+?)\.pdf'
-        ]
-        
-        # Patterns anglais
-        patterns_en = [
-            rf'Trade[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf',
-            rf'Package[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf',
-            rf'Work[-_\s]*{lot_number}[-_\s]+(.+?)\.pdf'
-        ]
-        
-        all_patterns = patterns_fr + patterns_en
-        
-        for pattern in all_patterns:
-            match = re.search(pattern, filename, re.IGNORECASE)
+        for pattern in _filename_regexes(lot_number):
+            match = pattern.search(filename)
             if match:
                 name = match.group(1)
                 # Nettoyer
-                name = re.sub(r'[-_]+', ' ', name)
-                name = re.sub(r'\b(CCTP|DCE|PDF|DOC|Trade|Package)\b', '', name, flags=re.IGNORECASE)
+                name = _SEPARATORS_RE.sub(' ', name)
+                name = _FILENAME_NOISE_RE.sub('', name)
                 name = ' '.join(word.capitalize() for word in name.split())
                 return name.strip()
         
@@ -284,18 +494,17 @@ class AdvancedLotDetector:
         """
         
         # Chercher "Lot XX" dans le texte
-        pattern = rf'Lot\s*{lot_number}\s*[-:]\s*([^\n]+)'
-        matches = re.finditer(pattern, full_text, re.IGNORECASE)
+        matches = _lot_title_regex(lot_number).finditer(full_text)
         
         candidates = []
         for match in matches:
             potential_name = match.group(1).strip()
             # Nettoyer
-            potential_name = re.sub(r'\s+', ' ', potential_name)
+            potential_name = _WHITESPACE_RE.sub(' ', potential_name)
             potential_name = potential_name.split('.')[0]  # Prendre jusqu'au premier point
             
             # Vérifier si c'est un vrai nom (pas juste "Lot XX")
-            if len(potential_name) > 5 and not re.match(r'^Lot\s*\d+', potential_name):
+            if len(potential_name) > 5 and not _LOT_PREFIX_RE.match(potential_name):
                 candidates.append(potential_name)
         
         # Retourner le candidat le plus fréquent
@@ -312,108 +521,164 @@ class AdvancedLotDetector:
         """
         
         # Extraire le contexte autour du numéro de lot
-        pattern = rf'.{{0,200}}Lot\s*{lot_number}.{{0,200}}'
-        matches = re.findall(pattern, full_text, re.IGNORECASE)
+        matches = _lot_context_windows(lot_number, full_text)
         
         if not matches:
             return None
         
         context = ' '.join(matches).lower()
         
-        # Scorer chaque catégorie
-        scores = {}
-        for category, data in AdvancedLotDetector.LOT_CATEGORIES.items():
-            score = 0
-            # Mots-clés français
-            for keyword in data['keywords_fr']:
-                score += context.count(keyword)
-            # Mots-clés anglais
-            for keyword in data['keywords_en']:
-                score += context.count(keyword)
-            
-            if score > 0:
-                scores[category] = score
+        # Scorer chaque catégorie (une seule passe, mots-clés FR + EN)
+        counts = _scan_keywords(context, _LOT_CATEGORY_SCANNER)
+        scores = {
+            category: counts[category]
+            for category in AdvancedLotDetector.LOT_CATEGORIES
+            if counts[category] > 0
+        }
         
         # Retourner la catégorie avec le meilleur score
         if scores:
             best_category = max(scores, key=scores.get)
             # Traduire en nom de lot
-            category_names = {
-                'structure': 'Gros Œuvre / Structural Works',
-                'roofing': 'Charpente Couverture / Roofing',
-                'joinery': 'Menuiseries / Joinery',
-                'plumbing': 'Plomberie Sanitaire / Plumbing',
-                'electrical': 'Électricité / Electrical',
-                'vrd': 'VRD Aménagements Extérieurs / Site Works',
-                'finishes': 'Revêtements Finitions / Finishes'
-            }
-            return category_names.get(best_category, f"Travaux techniques - Lot {lot_number}")
+            return AdvancedLotDetector.CATEGORY_NAMES.get(
+                best_category, f"Travaux techniques - Lot {lot_number}"
+            )
         
         return None
 
 
+_LOT_CATEGORY_SCANNER = _build_keyword_scanner({
+    category: data['keywords_fr'] + data['keywords_en']
+    for category, data in AdvancedLotDetector.LOT_CATEGORIES.items()
+})
+
+
 # ========================================
 # ALGORITHME 2 AMÉLIORÉ : REMPLISSAGE INTELLIGENT
 # ========================================
 
+# Mots-clés de _detect_category, par ordre de priorité (la première catégorie trouvée l'emporte)
+_DETECT_CATEGORY_KEYWORDS = {
+    'structure': ['gros', 'œuvre', 'structure', 'béton', 'fondation', 'maçonnerie'],
+    'roofing': ['charpente', 'couverture', 'zinguerie', 'étanchéité', 'toiture'],
+    'joinery': ['menuiserie', 'fenêtre', 'porte', 'huisserie', 'fermeture'],
+    'electrical': ['électric', 'courant', 'éclairage', 'cfo', 'cfa', 'electrical'],
+    'plumbing': ['plomberie', 'sanitaire', 'eau', 'évacuation', 'plumbing'],
+    'vrd': ['vrd', 'voirie', 'réseau', 'aménagement', 'extérieur', 'site works'],
+    'finishes': ['peinture', 'revêtement', 'carrelage', 'finition', 'sol', 'painting', 'flooring'],
+}
+
+_DETECT_CATEGORY_SCANNER = _build_keyword_scanner(_DETECT_CATEGORY_KEYWORDS)
+
+# Placeholders signalant un contenu non rédigé (une seule recherche, sans copie .lower())
+_PLACEHOLDER_RE = re.compile('|'.join(re.escape(placeholder) for placeholder in [
+    'à préciser', 'à définir', 'détails', 'non spécifié',
+    'à compléter', 'tbd', 'tbc', 'n/a'
+]), re.IGNORECASE)
+
+
 class IntelligentFiller:
     """Remplissage intelligent avec IA"""
     
+    # Templates par catégorie (génération sémantique, niveau 3)
+    SEMANTIC_TEMPLATES = {
+        'structure': {
+            'description': "Réalisation des ouvrages de structure en béton armé conformément aux plans d'exécution. Mise en œuvre des fondations, poteaux, poutres et dalles selon les règles de l'art. Respect strict des prescriptions du CCTP et des normes en vigueur.",
+            'specifications': "Béton de qualité certifiée, ferraillage selon plans BE, coffrages conformes aux tolérances réglementaires.",
+            'materials': ["Béton", "Acier", "Coffrages"]
+        },
+        'roofing': {
+            'description': "Fourniture et pose de charpente selon plans. Couverture étanche et durable avec matériaux certifiés. Traitement préventif des bois. Mise en œuvre conforme aux normes applicables.",
+            'specifications': "Bois traités classe 2 minimum, couverture garantie 10 ans, zinguerie inox ou zinc naturel.",
+            'materials': ["Bois", "Couverture", "Zinc"]
+        },
+        'joinery': {
+            'description': "Fourniture et pose de menuiseries extérieures et/ou intérieures. Performances thermiques et acoustiques conformes à la réglementation. Quincaillerie de sécurité certifiée, vitrages adaptés à l'usage.",
+            'specifications': "Performances thermiques Uw ≤ 1.4 W/m²K, acoustique Rw ≥ 28 dB, certification NF ou équivalent.",
+            'materials': ["Menuiseries", "Vitrages", "Quincaillerie"]
+        },
+        'electrical': {
+            'description': "Installation électrique complète conforme aux normes en vigueur. Fourniture et pose des chemins de câbles, gaines, appareillages. Mise en service avec vérifications réglementaires. Respect des prescriptions de sécurité.",
+            'specifications': "Conformité normes électriques, protection différentielle 30mA, tableaux pré-câblés certifiés.",
+            'materials': ["Câbles", "Tableaux électriques", "Appareillages"]
+        },
+        'plumbing': {
+            'description': "Installation des réseaux d'eau potable, eaux usées et eaux pluviales. Fourniture et pose des équipements sanitaires certifiés. Calorifugeage des réseaux et dispositifs anti-retour réglementaires.",
+            'specifications': "Canalisations certifiées, équipements sanitaires conformes, protection anti-retour.",
+            'materials': ["Canalisations", "Équipements sanitaires", "Robinetterie"]
+        },
+        'vrd': {
+            'description': "Travaux de voirie, réseaux divers et aménagements extérieurs. Terrassements, fondations de voirie, mise en œuvre des enrobés. Pose des réseaux enterrés. Conformité aux normes voirie.",
+            'specifications': "Enrobés certifiés, réseaux conformes prescriptions gestionnaires, contrôles de compactage.",
+            'materials': ["Enrobés", "Bordures", "Réseaux"]
+        },
+        'finishes': {
+            'description': "Fourniture et pose de revêtements de sols et murs. Application de peintures et revêtements conformes aux normes. Préparation soignée des supports. Nombre de couches adapté à chaque support et usage.",
+            'specifications': "Classification UPEC adaptée, peintures certifiées, mise en œuvre conforme aux règles professionnelles.",
+            'materials': ["Peintures", "Revêtements", "Enduits"]
+        },
+        'default': {
+            'description': "Prestations réalisées dans le strict respect des règles de l'art. Conformité aux Documents Techniques Unifiés applicables. Mise en œuvre selon les prescriptions des fabricants et du cahier des charges. Contrôles qualité systématiques en cours d'exécution.",
+            'specifications': "Mise en œuvre conforme aux règles de l'art et aux prescriptions du marché.",
+            'materials': ["Matériaux certifiés", "Composants normalisés"]
+        }
+    }
+    
     def __init__(self):
         self.ai_generator = AIContentGenerator()
     
-    def generate_content(
+    async def generate_content(
         self,
-        lot: Dict[str, Any],
+        lots: List[Dict[str, Any]],
         project_context: str,
         full_text: str,
         use_ai: bool = True
-    ) -> Dict[str, Any]:
+    ) -> List[Dict[str, Any]]:
         """
-        Génère du contenu intelligent pour un lot
+        Génère du contenu intelligent pour tous les lots
         Stratégie à 4 niveaux :
         1. Contenu existant valide → Garder
-        2. IA Claude → Générer du contenu sur mesure
+        2. IA Claude → Générer du contenu sur mesure (appels en parallèle)
         3. Extraction sémantique → Mots-clés + templates
         4. Fallback → Templates génériques professionnels
         """
         
-        lot_name = lot.get('name', '')
-        lot_number = lot.get('number', 'XX')
-        existing_description = lot.get('description', '')
+        # Niveau 1 : Contenu existant valide ? → Garder tel quel
+        to_fill = [
+            lot for lot in lots
+            if not self._is_valid_content(lot.get('description', ''))
+        ]
         
-        # Niveau 1 : Contenu existant valide ?
-        if self._is_valid_content(existing_description):
-            return lot  # ✅ Garder tel quel
+        if not to_fill:
+            return lots
         
         # Niveau 2 : Génération IA (si activée et disponible)
         if use_ai:
             try:
-                ai_content = self.ai_generator.generate_lot_description(
-                    lot_name=lot_name,
-                    lot_number=lot_number,
-                    project_context=project_context,
-                    existing_content=existing_description
+                ai_contents = await self.ai_generator.generate_lot_descriptions_batch(
+                    lots=to_fill,
+                    project_context=project_context
                 )
                 
-                # Mettre à jour le lot
-                lot['description'] = ai_content.get('description', existing_description)
-                lot['specifications'] = ai_content.get('specifications', lot.get('specifications', ''))
-                if ai_content.get('materials'):
-                    lot['materials'] = ai_content['materials']
-                lot['ai_generated'] = True
+                # Mettre à jour les lots
+                for lot, ai_content in zip(to_fill, ai_contents):
+                    lot['description'] = ai_content.get('description', lot.get('description', ''))
+                    lot['specifications'] = ai_content.get('specifications', lot.get('specifications', ''))
+                    if ai_content.get('materials'):
+                        lot['materials'] = ai_content['materials']
+                    lot['ai_generated'] = True
                 
-                return lot
+                return lots
                 
             except Exception as e:
                 # Continuer vers niveau 3 si IA échoue
                 pass
         
-        # Niveau 3 : Extraction sémantique + templates
-        semantic_content = self._semantic_generation(lot, full_text)
-        lot.update(semantic_content)
+        # Niveau 3 : Extraction sémantique + templates (classification en un lot)
+        for lot, category in zip(to_fill, self.classify_batch(to_fill)):
+            lot.update(self._semantic_generation(category))
         
-        return lot
+        return lots
     
     @staticmethod
     def _is_valid_content(content: str) -> bool:
@@ -421,102 +686,41 @@ class IntelligentFiller:
         if not content or len(content) < 30:
             return False
         
-        placeholders = [
-            'à préciser', 'à définir', 'détails', 'non spécifié',
-            'à compléter', 'tbd', 'tbc', 'n/a'
+        return _PLACEHOLDER_RE.search(content) is None
+    
+    @staticmethod
+    def classify_batch(lots: List[Dict[str, Any]]) -> List[str]:
+        """Détecte la catégorie de chaque lot (nom + description), sans appel IA"""
+        return [
+            IntelligentFiller._detect_category(
+                f"{lot.get('name', '')} {lot.get('description', '')}"
+            )
+            for lot in lots
         ]
-        
-        content_lower = content.lower()
-        for placeholder in placeholders:
-            if placeholder in content_lower:
-                return False
-        
-        return True
     
     @staticmethod
-    def _semantic_generation(lot: Dict[str, Any], full_text: str) -> Dict[str, Any]:
-        """Génération sémantique (niveau 3)"""
-        
-        lot_name = lot.get('name', '').lower()
-        lot_description = lot.get('description', '').lower()
-        combined = f"{lot_name} {lot_description}"
-        
-        # Détecter la catégorie
-        category = IntelligentFiller._detect_category(combined)
-        
-        # Templates par catégorie
-        templates = {
-            'structure': {
-                'description': "Réalisation des ouvrages de structure en béton armé conformément aux plans d'exécution. Mise en œuvre des fondations, poteaux, poutres et dalles selon les règles de l'art. Respect strict des prescriptions du CCTP et des normes en vigueur.",
-                'specifications': "Béton de qualité certifiée, ferraillage selon plans BE, coffrages conformes aux tolérances réglementaires.",
-                'materials': ["Béton", "Acier", "Coffrages"]
-            },
-            'roofing': {
-                'description': "Fourniture et pose de charpente selon plans. Couverture étanche et durable avec matériaux certifiés. Traitement préventif des bois. Mise en œuvre conforme aux normes applicables.",
-                'specifications': "Bois traités classe 2 minimum, couverture garantie 10 ans, zinguerie inox ou zinc naturel.",
-                'materials': ["Bois", "Couverture", "Zinc"]
-            },
-            'joinery': {
-                'description': "Fourniture et pose de menuiseries extérieures et/ou intérieures. Performances thermiques et acoustiques conformes à la réglementation. Quincaillerie de sécurité certifiée, vitrages adaptés à l'usage.",
-                'specifications': "Performances thermiques Uw ≤ 1.4 W/m²K, acoustique Rw ≥ 28 dB, certification NF ou équivalent.",
-                'materials': ["Menuiseries", "Vitrages", "Quincaillerie"]
-            },
-            'electrical': {
-                'description': "Installation électrique complète conforme aux normes en vigueur. Fourniture et pose des chemins de câbles, gaines, appareillages. Mise en service avec vérifications réglementaires. Respect des prescriptions de sécurité.",
-                'specifications': "Conformité normes électriques, protection différentielle 30mA, tableaux pré-câblés certifiés.",
-                'materials': ["Câbles", "Tableaux électriques", "Appareillages"]
-            },
-            'plumbing': {
-                'description': "Installation des réseaux d'eau potable, eaux usées et eaux pluviales. Fourniture et pose des équipements sanitaires certifiés. Calorifugeage des réseaux et dispositifs anti-retour réglementaires.",
-                'specifications': "Canalisations certifiées, équipements sanitaires conformes, protection anti-retour.",
-                'materials': ["Canalisations", "Équipements sanitaires", "Robinetterie"]
-            },
-            'vrd': {
-                'description': "Travaux de voirie, réseaux divers et aménagements extérieurs. Terrassements, fondations de voirie, mise en œuvre des enrobés. Pose des réseaux enterrés. Conformité aux normes voirie.",
-                'specifications': "Enrobés certifiés, réseaux conformes prescriptions gestionnaires, contrôles de compactage.",
-                'materials': ["Enrobés", "Bordures", "Réseaux"]
-            },
-            'finishes': {
-                'description': "Fourniture et pose de revêtements de sols et murs. Application de peintures et revêtements conformes aux normes. Préparation soignée des supports. Nombre de couches adapté à chaque support et usage.",
-                'specifications': "Classification UPEC adaptée, peintures certifiées, mise en œuvre conforme aux règles professionnelles.",
-                'materials': ["Peintures", "Revêtements", "Enduits"]
-            },
-            'default': {
-                'description': "Prestations réalisées dans le strict respect des règles de l'art. Conformité aux Documents Techniques Unifiés applicables. Mise en œuvre selon les prescriptions des fabricants et du cahier des charges. Contrôles qualité systématiques en cours d'exécution.",
-                'specifications': "Mise en œuvre conforme aux règles de l'art et aux prescriptions du marché.",
-                'materials': ["Matériaux certifiés", "Composants normalisés"]
-            }
-        }
-        
-        template = templates.get(category, templates['default'])
+    def _semantic_generation(category: str) -> Dict[str, Any]:
+        """Génération sémantique (niveau 3) depuis la catégorie du lot"""
+        template = IntelligentFiller.SEMANTIC_TEMPLATES.get(
+            category, IntelligentFiller.SEMANTIC_TEMPLATES['default']
+        )
         
         return {
             'description': template['description'],
             'specifications': template['specifications'],
-            'materials': template['materials']
+            'materials': list(template['materials'])
         }
     
     @staticmethod
     def _detect_category(text: str) -> str:
         """Détecte la catégorie d'un lot"""
-        text = text.lower()
-        
-        if any(kw in text for kw in ['gros', 'œuvre', 'structure', 'béton', 'fondation', 'maçonnerie']):
-            return 'structure'
-        elif any(kw in text for kw in ['charpente', 'couverture', 'zinguerie', 'étanchéité', 'toiture']):
-            return 'roofing'
-        elif any(kw in text for kw in ['menuiserie', 'fenêtre', 'porte', 'huisserie', 'fermeture']):
-            return 'joinery'
-        elif any(kw in text for kw in ['électric', 'courant', 'éclairage', 'cfo', 'cfa', 'electrical']):
-            return 'electrical'
-        elif any(kw in text for kw in ['plomberie', 'sanitaire', 'eau', 'évacuation', 'plumbing']):
-            return 'plumbing'
-        elif any(kw in text for kw in ['vrd', 'voirie', 'réseau', 'aménagement', 'extérieur', 'site works']):
-            return 'vrd'
-        elif any(kw in text for kw in ['peinture', 'revêtement', 'carrelage', 'finition', 'sol', 'painting', 'flooring']):
-            return 'finishes'
-        else:
-            return 'default'
+        counts = _scan_keywords(text.lower(), _DETECT_CATEGORY_SCANNER)
+        
+        for category in _DETECT_CATEGORY_KEYWORDS:
+            if counts[category]:
+                return category
+        
+        return 'default'
 
 
 # ========================================
@@ -638,31 +842,45 @@ class UniversalRiskSolver:
         Récupère ou génère une solution pour un risque
         """
         
-        risk_lower = risk_keyword.lower()
-        
-        # Niveau 1 : Base de données
-        if risk_lower in self.SOLUTIONS_DATABASE:
-            return self.SOLUTIONS_DATABASE[risk_lower]
+        # Mots-clés souvent déjà en minuscules : pas de copie dans ce cas
+        risk_lower = risk_keyword if risk_keyword.islower() else risk_keyword.lower()
         
-        # Niveau 2 : Recherche partielle (si mot-clé contenu)
-        for key, solution in self.SOLUTIONS_DATABASE.items():
-            if key in risk_lower or risk_lower in key:
-                return solution
+        # Niveaux 1-2 : Base de données (déterministe, mémoïsé par mot-clé)
+        solution = self._lookup_solution(risk_lower)
+        if solution is not None:
+            return solution
         
         # Niveau 3 : Génération IA (si activée)
         if use_ai and risk_full_description:
-            try:
-                ai_solution = self.ai_generator.generate_risk_solution(
-                    risk_description=risk_full_description,
-                    project_context=project_context
-                )
+            ai_solution = self.ai_generator.generate_risk_solution(
+                risk_description=risk_full_description,
+                project_context=project_context
+            )
+            if ai_solution:
                 return ai_solution
-            except:
-                pass
         
         # Niveau 4 : Fallback générique professionnel
         return self._generate_generic_solution(risk_keyword)
     
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _lookup_solution(risk_lower: str) -> Optional[str]:
+        """
+        Niveaux 1-2 de get_solution (sans IA) : un même risque revient souvent
+        plusieurs fois dans un document, la recherche n'est faite qu'une fois
+        """
+        # Niveau 1 : Base de données (une seule recherche de hash)
+        solution = UniversalRiskSolver.SOLUTIONS_DATABASE.get(risk_lower)
+        if solution is not None:
+            return solution
+        
+        # Niveau 2 : Recherche partielle (si mot-clé contenu)
+        partial_key = _find_partial_solution_key(risk_lower)
+        if partial_key is not None:
+            return UniversalRiskSolver.SOLUTIONS_DATABASE[partial_key]
+        
+        return None
+    
     @staticmethod
     def _generate_generic_solution(risk_keyword: str) -> str:
         """Génère une solution générique crédible"""
@@ -673,6 +891,36 @@ class UniversalRiskSolver:
         )
 
 
+# Index de la recherche partielle de get_solution (clés dans l'ordre du dictionnaire)
+_SOLUTION_KEYS = list(UniversalRiskSolver.SOLUTIONS_DATABASE)
+_SOLUTION_KEY_RANK = {key: rank for rank, key in enumerate(_SOLUTION_KEYS)}
+# "clé contenue dans le risque" : une passe regex sur le risque
+_SOLUTION_KEY_SCANNER = _build_keyword_scanner({key: [key] for key in _SOLUTION_KEYS})
+# "risque contenu dans une clé" : un seul find() sur les clés concaténées
+_SOLUTION_KEYS_JOINED = '\0'.join(_SOLUTION_KEYS)
+_SOLUTION_KEY_OFFSETS = []
+_offset = 0
+for _key in _SOLUTION_KEYS:
+    _SOLUTION_KEY_OFFSETS.append(_offset)
+    _offset += len(_key) + 1
+del _offset, _key
+
+
+def _find_partial_solution_key(risk_lower: str) -> Optional[str]:
+    """
+    Première clé (ordre du dictionnaire) telle que clé ⊂ risque ou risque ⊂ clé
+    Équivalent à la boucle sur SOLUTIONS_DATABASE, sans ~2 tests `in` par clé
+    """
+    ranks = [_SOLUTION_KEY_RANK[key] for key in _scan_keywords(risk_lower, _SOLUTION_KEY_SCANNER)]
+    
+    if '\0' not in risk_lower:
+        position = _SOLUTION_KEYS_JOINED.find(risk_lower)
+        if position != -1:
+            ranks.append(bisect_right(_SOLUTION_KEY_OFFSETS, position) - 1)
+    
+    return _SOLUTION_KEYS[min(ranks)] if ranks else None
+
+
 # ========================================
 # ALGORITHME 4 AMÉLIORÉ : CONTEXTUALISATION UNIVERSELLE
 # ========================================
@@ -815,52 +1063,25 @@ class UniversalContextualizer:
     ) -> List[str]:
         """Détecte tous les contextes applicables"""
         
-        detected = []
-        
-        # Récupérer les infos
-        location = project_info.get('location', '').lower()
-        client = project_info.get('client', '').lower()
-        postal_code = project_info.get('postal_code', '')
-        
-        combined_text = f"{location} {client} {full_text[:3000]}".lower()
-        
-        # Vérifier chaque contexte
-        for context_key, context_data in UniversalContextualizer.CONTEXTS_DATABASE.items():
-            detection_config = context_data.get('detection', {})
-            
-            # Vérifier codes postaux
-            if postal_code:
-                postal_patterns = detection_config.get('postal_codes', [])
-                for pattern in postal_patterns:
-                    if re.match(pattern, postal_code):
-                        detected.append(context_key)
-                        break
-            
-            # Vérifier mots-clés
-            keywords = detection_config.get('keywords', [])
-            for keyword in keywords:
-                if keyword in combined_text:
-                    detected.append(context_key)
-                    break
-        
-        return list(set(detected))  # Dédupliquer
+        # Récupérer les infos (une lecture par champ ; null JSON traité comme vide)
+        # Seuls ces champs et les 3000 premiers caractères comptent : ils forment la clé du cache
+        get_info = project_info.get
+        return list(_detect_contexts_cached(
+            get_info('location') or '',
+            get_info('client') or '',
+            get_info('postal_code') or '',
+            full_text[:3000]
+        ))
     
     @staticmethod
     def generate_context_content(contexts: List[str]) -> Dict[str, List[str]]:
         """Génère le contenu contextuel"""
         
-        result = {'methodologie': [], 'qse': []}
-        
-        for context in contexts:
-            context_data = UniversalContextualizer.CONTEXTS_DATABASE.get(context, {})
-            specific_content = context_data.get('specific_content', [])
-            
-            if specific_content:
-                # Déterminer la section (méthodologie par défaut)
-                section = 'methodologie'
-                result[section].extend(specific_content)
-        
-        return result
+        # Contenu assemblé une fois par combinaison de contextes (listes neuves pour l'appelant)
+        return {
+            'methodologie': list(_assemble_context_content(tuple(contexts))),
+            'qse': []
+        }
     
     @staticmethod
     def adapt_norms_references(
@@ -869,32 +1090,111 @@ class UniversalContextualizer:
     ) -> str:
         """Adapte les références normatives selon le contexte"""
         
-        # Déterminer les normes applicables
-        applicable_norms = set()
-        for context in contexts:
-            context_data = UniversalContextualizer.CONTEXTS_DATABASE.get(context, {})
-            norms = context_data.get('norms', [])
-            applicable_norms.update(norms)
-        
-        # Si contexte UK détecté, remplacer DTU par BS
-        if 'uk' in contexts:
-            content = re.sub(r'\bDTU\b', 'BS (British Standard)', content)
-            content = re.sub(r'\bNF C 15-100\b', 'BS 7671 (Wiring Regulations)', content)
-        
-        # Si contexte US détecté, remplacer par normes US
-        if 'usa' in contexts:
-            content = re.sub(r'\bDTU\b', 'ASTM', content)
-            content = re.sub(r'\bEurocode\b', 'ACI / IBC', content)
-            content = re.sub(r'\bNF C 15-100\b', 'NEC (National Electrical Code)', content)
-        
-        # Si contexte Canada détecté
-        if 'canada' in contexts:
-            content = re.sub(r'\bDTU\b', 'CSA Standards', content)
-            content = re.sub(r'\bNF C 15-100\b', 'CEC (Canadian Electrical Code)', content)
+        # Remplacements des contextes détectés (UK > USA > Canada si plusieurs),
+        # appliqués en une seule passe sur le contenu
+        replacements: Dict[str, str] = {}
+        for context, context_replacements in reversed(_NORM_REPLACEMENTS):
+            if context in contexts:
+                replacements.update(context_replacements)
+        
+        if replacements:
+            content = _NORM_REFERENCE_RE.sub(
+                lambda match: replacements.get(match.lastgroup, match.group()),
+                content
+            )
         
         return content
 
 
+# Index à plat de CONTEXTS_DATABASE, construits une seule fois (plus de .get() imbriqués par appel)
+_CONTEXT_KEYS = tuple(UniversalContextualizer.CONTEXTS_DATABASE)
+
+_CONTEXT_SPECIFIC_CONTENT = {
+    context_key: tuple(context_data.get('specific_content', []))
+    for context_key, context_data in UniversalContextualizer.CONTEXTS_DATABASE.items()
+}
+
+
+@lru_cache(maxsize=128)
+def _assemble_context_content(contexts: Tuple[str, ...]) -> Tuple[str, ...]:
+    """Contenu spécifique des contextes, dans l'ordre donné (section méthodologie)"""
+    return tuple(
+        line
+        for context in contexts
+        for line in _CONTEXT_SPECIFIC_CONTENT.get(context, ())
+    )
+
+
+def _build_context_postal_regex() -> Tuple[re.Pattern, Dict[str, str]]:
+    """
+    Codes postaux de tous les contextes en un seul pattern : un lookahead optionnel
+    par contexte, le groupe nommé est renseigné si le code correspond
+    (plusieurs contextes possibles, ex. 5 chiffres → france + usa)
+    """
+    branches = []
+    groups = {}
+    for context_key, context_data in UniversalContextualizer.CONTEXTS_DATABASE.items():
+        postal_patterns = context_data.get('detection', {}).get('postal_codes', [])
+        if postal_patterns:
+            group = f"ctx{len(groups)}"
+            groups[group] = context_key
+            alternation = '|'.join(f'(?:{pattern})' for pattern in postal_patterns)
+            branches.append(f'(?:(?=(?P<{group}>{alternation})))?')
+    return re.compile(''.join(branches)), groups
+
+
+_CONTEXT_POSTAL_RE, _CONTEXT_POSTAL_GROUPS = _build_context_postal_regex()
+
+
+def _match_postal_contexts(postal_code: str) -> set:
+    """Contextes dont un pattern de code postal correspond (re.match)"""
+    match = _CONTEXT_POSTAL_RE.match(postal_code)
+    return {
+        _CONTEXT_POSTAL_GROUPS[group]
+        for group, value in match.groupdict().items()
+        if value is not None
+    }
+
+
+@lru_cache(maxsize=256)
+def _detect_contexts_cached(
+    location: str,
+    client: str,
+    postal_code: str,
+    text_head: str
+) -> Tuple[str, ...]:
+    """Détection des contextes, mémoïsée : une ré-exportation ne rescanne pas le texte"""
+    
+    # Un seul lower() sur le texte combiné
+    combined_text = f"{location} {client} {text_head}".lower()
+    
+    # Mots-clés de tous les contextes : une seule passe sur le texte
+    keyword_hits = _scan_keywords(combined_text, _CONTEXT_KEYWORD_SCANNER)
+    
+    # Codes postaux : tous les contextes testés en un seul match (pas de code → rien à faire)
+    postal_hits = _match_postal_contexts(postal_code) if postal_code else set()
+    
+    # Ordre de CONTEXTS_DATABASE, chaque contexte une seule fois
+    return tuple(
+        context_key for context_key in _CONTEXT_KEYS
+        if context_key in postal_hits or keyword_hits[context_key]
+    )
+
+# Références normatives françaises à adapter, et leurs équivalents par contexte
+# (ordre = priorité : le premier contexte détecté l'emporte)
+_NORM_REFERENCE_RE = re.compile(r'\b(?:(?P<DTU>DTU)|(?P<EUROCODE>Eurocode)|(?P<NFC>NF C 15-100))\b')
+_NORM_REPLACEMENTS = [
+    ('uk', {'DTU': 'BS (British Standard)', 'NFC': 'BS 7671 (Wiring Regulations)'}),
+    ('usa', {'DTU': 'ASTM', 'EUROCODE': 'ACI / IBC', 'NFC': 'NEC (National Electrical Code)'}),
+    ('canada', {'DTU': 'CSA Standards', 'NFC': 'CEC (Canadian Electrical Code)'}),
+]
+
+_CONTEXT_KEYWORD_SCANNER = _build_keyword_scanner({
+    context_key: context_data.get('detection', {}).get('keywords', [])
+    for context_key, context_data in UniversalContextualizer.CONTEXTS_DATABASE.items()
+})
+
+
 # ========================================
 # SYSTÈME DE VALIDATION DE QUALITÉ
 # ========================================
@@ -914,30 +1214,32 @@ class QualityValidator:
         
         # Vérifier les lots
         lots = analysis_result.get('lots', [])
-        if not lots or len(lots) == 0:
+        if not lots:
             score -= 30
             issues.append("Aucun lot détecté - Vérifier l'extraction")
         else:
-            # Vérifier chaque lot
+            # Vérifier chaque lot (une passe, pénalité appliquée en une fois)
+            is_ghost_lot = AdvancedLotDetector.is_ghost_lot
+            add_warning = warnings.append
+            penalty = 0
             for lot in lots:
                 lot_number = lot.get('number', '??')
-                lot_name = lot.get('name', '')
                 
                 # Nom de lot fantôme ?
-                if AdvancedLotDetector.is_ghost_lot(lot_name):
-                    score -= 5
-                    warnings.append(f"Lot {lot_number} : Nom générique détecté")
+                if is_ghost_lot(lot.get('name', '')):
+                    penalty += 5
+                    add_warning(f"Lot {lot_number} : Nom générique détecté")
                 
                 # Description vide ?
                 description = lot.get('description', '')
                 if not description or len(description) < 30:
-                    score -= 5
-                    warnings.append(f"Lot {lot_number} : Description courte")
+                    penalty += 5
+                    add_warning(f"Lot {lot_number} : Description courte")
+            score -= penalty
         
         # Vérifier les exigences critiques
         requirements = analysis_result.get('requirements', [])
-        eliminatory_reqs = [r for r in requirements if r.get('is_eliminatory')]
-        if len(eliminatory_reqs) == 0:
+        if not any(r.get('is_eliminatory') for r in requirements):
             score -= 10
             warnings.append("Aucune exigence éliminatoire détectée - À vérifier")
         
@@ -985,20 +1287,62 @@ def add_colored_paragraph(doc, text, color_rgb=(0, 0, 0), bold=False, font_size=
         run.font.bold = True
     return para
 
+# Noms d'attributs qualifiés calculés une seule fois
+_QN_FILL = qn('w:fill')
+_QN_VAL = qn('w:val')
+_QN_XML_SPACE = qn('xml:space')
+
+
+def add_bullet_list(doc, items, style_name='List Bullet'):
+    """
+    Ajoute une liste à puces en un bloc : style résolu une seule fois,
+    chaque <w:p> est cloné d'un modèle XML au lieu d'un add_paragraph(style=...)
+    """
+    if not items:
+        return
+    
+    template = OxmlElement('w:p')
+    p_pr = OxmlElement('w:pPr')
+    p_style = OxmlElement('w:pStyle')
+    p_style.set(_QN_VAL, doc.styles[style_name].style_id)
+    p_pr.append(p_style)
+    template.append(p_pr)
+    run = OxmlElement('w:r')
+    text = OxmlElement('w:t')
+    text.set(_QN_XML_SPACE, 'preserve')
+    run.append(text)
+    template.append(run)
+    
+    # Insertion avant <w:sectPr>, comme Document.add_paragraph
+    body = doc.element.body
+    sect_pr = body.sectPr
+    insert = sect_pr.addprevious if sect_pr is not None else body.append
+    for item in items:
+        paragraph = copy.deepcopy(template)
+        paragraph[-1][0].text = item
+        insert(paragraph)
+
+
 def add_table_row(table, cells_data, is_header=False):
     """Ajoute une ligne à un tableau"""
     row = table.add_row()
+    cells = row.cells
+    
+    # En-tête : un seul élément de fond construit, copié dans chaque cellule
+    if is_header:
+        header_shading = OxmlElement('w:shd')
+        header_shading.set(_QN_FILL, 'E7E7E7')
+    
     for i, cell_data in enumerate(cells_data):
-        cell = row.cells[i]
+        cell = cells[i]
         cell.text = str(cell_data)
         if is_header:
             cell.paragraphs[0].runs[0].font.bold = True
-            shading_elm = OxmlElement('w:shd')
-            shading_elm.set(qn('w:fill'), 'E7E7E7')
-            cell._element.get_or_add_tcPr().append(shading_elm)
+            cell._element.get_or_add_tcPr().append(copy.deepcopy(header_shading))
 
+@lru_cache(maxsize=512)
 def format_currency(amount):
-    """Formate un montant en euros"""
+    """Formate un montant en euros (mémoïsé : mêmes montants répétés dans le document)"""
     if amount is None:
         return "Non spécifié"
     return f"{amount:,.2f} €".replace(',', ' ')
@@ -1007,10 +1351,17 @@ def format_date(date_str):
     """Formate une date"""
     if not date_str or date_str == "null":
         return "Non spécifiée"
+    if not isinstance(date_str, str):
+        return date_str
+    return _format_iso_date(date_str)
+
+@lru_cache(maxsize=512)
+def _format_iso_date(date_str: str) -> str:
+    """Parse + formatage d'une date ISO, mémoïsé par chaîne"""
     try:
         date_obj = datetime.fromisoformat(date_str)
         return date_obj.strftime("%d/%m/%Y")
-    except:
+    except ValueError:
         return date_str
 
 
@@ -1018,14 +1369,78 @@ def format_date(date_str):
 # MAIN DOCX GENERATION - V4.0 ULTIMATE
 # ========================================
 
-def create_docx_from_analysis(
+# Dossier des mémoires générés
+DOCUMENTS_DIR = "/tmp/documents" if os.path.exists("/tmp") else "./documents"
+
+
+def _safe_project_name(project_name: str) -> str:
+    return (project_name or "Projet").replace(' ', '_').replace('/', '_')[:50]
+
+
+def _docx_cache_path(analysis_result: dict, user_id: int) -> str:
+    """
+    Chemin du DOCX adressé par contenu (utilisateur + résultat d'analyse)
+    Un résultat identique n'est jamais régénéré, un résultat modifié l'est toujours
+    """
+    digest = hashlib.blake2b(
+        orjson.dumps([user_id, analysis_result], option=orjson.OPT_SORT_KEYS),
+        digest_size=16
+    ).hexdigest()
+    return os.path.join(DOCUMENTS_DIR, f"{digest}.docx")
+
+
+# Styles de paragraphe du mémoire : (nom, taille pt, gras, italique, couleur, centré)
+_PARAGRAPH_STYLES = [
+    ('BK Generation Date', 10, None, True, RGBColor(107, 114, 128), True),
+    ('BK Quality Score', 9, None, True, RGBColor(156, 163, 175), True),
+    ('BK AI Indicator', 8, None, True, RGBColor(156, 163, 175), False),
+    ('BK Lot Reference', 9, None, True, RGBColor(107, 114, 128), False),
+    ('BK Lot Budget', None, True, None, RGBColor(16, 185, 129), False),
+    ('BK Footer', 8, None, True, RGBColor(156, 163, 175), True),
+]
+
+
+@lru_cache(maxsize=1)
+def _base_document_bytes() -> bytes:
+    """
+    Modèle de base du mémoire (styles par défaut + marges), construit une seule fois
+    Chaque export recharge ces octets au lieu de relire le modèle python-docx sur disque
+    et de reconfigurer les sections
+    """
+    doc = Document()
+    
+    # Configuration globale
+    for section in doc.sections:
+        section.top_margin = Inches(1)
+        section.bottom_margin = Inches(1)
+        section.left_margin = Inches(1)
+        section.right_margin = Inches(1)
+    
+    # Styles nommés : une définition partagée au lieu d'un <w:rPr> par paragraphe
+    for name, size, bold, italic, color, centered in _PARAGRAPH_STYLES:
+        style = doc.styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+        style.base_style = doc.styles['Normal']
+        if size:
+            style.font.size = Pt(size)
+        style.font.bold = bold
+        style.font.italic = italic
+        style.font.color.rgb = color
+        if centered:
+            style.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+async def build_docx_bytes(
     analysis_result: dict,
     project_name: str,
     available_files: List[str] = None,
     use_ai_generation: bool = True
-) -> str:
+) -> bytes:
     """
-    Génère un MÉMOIRE TECHNIQUE V4.0 ULTIMATE - 100% UNIVERSEL
+    Génère un MÉMOIRE TECHNIQUE V4.0 ULTIMATE - 100% UNIVERSEL (en mémoire)
     
     Intègre :
     - Analyse sémantique avancée
@@ -1042,19 +1457,11 @@ def create_docx_from_analysis(
     intelligent_filler = IntelligentFiller()
     risk_solver = UniversalRiskSolver()
     
-    doc = Document()
-    
-    # Configuration globale
-    sections = doc.sections
-    for section in sections:
-        section.top_margin = Inches(1)
-        section.bottom_margin = Inches(1)
-        section.left_margin = Inches(1)
-        section.right_margin = Inches(1)
-    
     project_info = analysis_result.get("project_info", {})
     requirements = analysis_result.get("requirements", [])
-    lots = analysis_result.get("lots", [])
+    # Copies superficielles : la reconstruction et le remplissage modifient les lots,
+    # jamais analysis_result (partagé avec la ligne ORM et la clé du cache DOCX)
+    lots = [dict(lot) for lot in analysis_result.get("lots", [])]
     technical_constraints = analysis_result.get("technical_constraints", {})
     suspended_opinions = analysis_result.get("suspended_opinions", [])
     risks = analysis_result.get("risks", [])
@@ -1071,12 +1478,94 @@ Budget : {project_info.get('budget_ht', 'Non spécifié')} € HT
 Durée : {project_info.get('duration_months', 'Non spécifiée')} mois
 """
     
-    full_text = str(analysis_result)
+    # Texte brut pour les détecteurs : orjson est bien plus rapide que str() sur un dict imbriqué
+    full_text = orjson.dumps(analysis_result).decode()
     
     # DÉTECTION CONTEXTE UNIVERSEL
     detected_contexts = UniversalContextualizer.detect_contexts(project_info, full_text)
     context_content = UniversalContextualizer.generate_context_content(detected_contexts)
     
+    # PRÉPARATION DES LOTS (avant construction du document)
+    if lots:
+        # Noms de fichiers concaténés une seule fois pour tous les lots
+        filenames_text = ' '.join(available_files or [])
+        
+        for lot in lots:
+            lot_number = lot.get('number', 'XX')
+            lot_name = lot.get('name', '')
+            
+            # ALGORITHME 1 AMÉLIORÉ : Récupération lots fantômes (multi-niveaux)
+            if AdvancedLotDetector.is_ghost_lot(lot_name):
+                # Tentative 1 : Nom de fichier
+                extracted_name = AdvancedLotDetector.extract_lot_from_filename(
+                    filename=filenames_text,
+                    lot_number=lot_number
+                ) if filenames_text else None
+                if extracted_name:
+                    lot['name'] = extracted_name
+                    lot['file_reference'] = "Extrait du nom de fichier"
+                else:
+                    # Tentative 2 : Analyse contenu
+                    content_name = AdvancedLotDetector.detect_lot_from_content(
+                        lot_number=lot_number,
+                        full_text=full_text
+                    )
+                    if content_name:
+                        lot['name'] = content_name
+                        lot['content_reference'] = "Extrait du contenu DCE"
+                    else:
+                        # Tentative 3 : Inférence par catégorie
+                        inferred_name = AdvancedLotDetector.infer_lot_from_category(
+                            lot_number=lot_number,
+                            full_text=full_text
+                        )
+                        if inferred_name:
+                            lot['name'] = inferred_name
+                            lot['inferred'] = True
+                
+                lot['reconstructed'] = True
+        
+        # ALGORITHME 2 AMÉLIORÉ : Remplissage intelligent (appels IA en parallèle)
+        lots = await intelligent_filler.generate_content(
+            lots=lots,
+            project_context=project_context,
+            full_text=full_text,
+            use_ai=use_ai_generation
+        )
+    
+    # CONSTRUCTION DU DOCUMENT (python-docx, CPU) : dans un thread, hors event loop
+    return await asyncio.to_thread(
+        _render_docx,
+        project_name=project_name,
+        project_info=project_info,
+        lots=lots,
+        quality_report=quality_report,
+        detected_contexts=detected_contexts
+    )
+
+
+def _write_docx_file(output_path: str, data: bytes) -> None:
+    """Écriture atomique : une requête concurrente ne voit jamais un fichier partiel"""
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, output_path)
+
+
+def _render_docx(
+    project_name: str,
+    project_info: Dict[str, Any],
+    lots: List[Dict[str, Any]],
+    quality_report: Dict[str, Any],
+    detected_contexts: List[str]
+) -> bytes:
+    """Construit le DOCX en mémoire (code bloquant, exécuté via asyncio.to_thread)"""
+    
+    # Document de base (styles + marges) chargé depuis le modèle en mémoire
+    doc = Document(io.BytesIO(_base_document_bytes()))
+    generated_at = datetime.now().strftime('%d/%m/%Y à %H:%M')
+    
     # PAGE DE GARDE
     title = doc.add_heading("MÉMOIRE TECHNIQUE", level=0)
     title.alignment = WD_ALIGN_PARAGRAPH.CENTER
@@ -1095,23 +1584,17 @@ Durée : {project_info.get('duration_months', 'Non spécifiée')} mois
         location_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
         location_para.runs[0].font.size = Pt(11)
     
-    date_para = doc.add_paragraph(
-        f"\nDocument généré le {datetime.now().strftime('%d/%m/%Y à %H:%M')}"
+    doc.add_paragraph(
+        f"\nDocument généré le {generated_at}",
+        style='BK Generation Date'
     )
-    date_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    date_para.runs[0].font.italic = True
-    date_para.runs[0].font.size = Pt(10)
-    date_para.runs[0].font.color.rgb = RGBColor(107, 114, 128)
     
     # Indicateur de qualité (si score < 90)
     if quality_report['score'] < 90:
-        quality_para = doc.add_paragraph(
-            f"📊 Score de qualité : {quality_report['score']}/100 - {quality_report['quality_level']}"
+        doc.add_paragraph(
+            f"📊 Score de qualité : {quality_report['score']}/100 - {quality_report['quality_level']}",
+            style='BK Quality Score'
         )
-        quality_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        quality_para.runs[0].font.size = Pt(9)
-        quality_para.runs[0].font.italic = True
-        quality_para.runs[0].font.color.rgb = RGBColor(156, 163, 175)
     
     doc.add_page_break()
     
@@ -1166,8 +1649,7 @@ Durée : {project_info.get('duration_months', 'Non spécifiée')} mois
     if project_info.get("moe"):
         characteristics.append(f"Maître d'Œuvre : {project_info['moe']}")
     
-    for char in characteristics:
-        doc.add_paragraph(char, style='List Bullet')
+    add_bullet_list(doc, characteristics)
     
     # SECTION 3 : LOTS TECHNIQUES (ALGORITHMES 1 & 2 AMÉLIORÉS)
     if lots and len(lots) > 0:
@@ -1180,46 +1662,6 @@ Durée : {project_info.get('duration_months', 'Non spécifiée')} mois
         
         for lot in lots:
             lot_number = lot.get('number', 'XX')
-            lot_name = lot.get('name', '')
-            
-            # ALGORITHME 1 AMÉLIORÉ : Récupération lots fantômes (multi-niveaux)
-            if AdvancedLotDetector.is_ghost_lot(lot_name):
-                # Tentative 1 : Nom de fichier
-                extracted_name = AdvancedLotDetector.extract_lot_from_filename(
-                    filename=' '.join(available_files or []),
-                    lot_number=lot_number
-                )
-                if extracted_name:
-                    lot['name'] = extracted_name
-                    lot['file_reference'] = "Extrait du nom de fichier"
-                else:
-                    # Tentative 2 : Analyse contenu
-                    content_name = AdvancedLotDetector.detect_lot_from_content(
-                        lot_number=lot_number,
-                        full_text=full_text
-                    )
-                    if content_name:
-                        lot['name'] = content_name
-                        lot['content_reference'] = "Extrait du contenu DCE"
-                    else:
-                        # Tentative 3 : Inférence par catégorie
-                        inferred_name = AdvancedLotDetector.infer_lot_from_category(
-                            lot_number=lot_number,
-                            full_text=full_text
-                        )
-                        if inferred_name:
-                            lot['name'] = inferred_name
-                            lot['inferred'] = True
-                
-                lot['reconstructed'] = True
-            
-            # ALGORITHME 2 AMÉLIORÉ : Remplissage intelligent (avec IA)
-            lot = intelligent_filler.generate_content(
-                lot=lot,
-                project_context=project_context,
-                full_text=full_text,
-                use_ai=use_ai_generation
-            )
             
             # Générer le contenu du lot
             doc.add_heading(
@@ -1242,10 +1684,7 @@ Durée : {project_info.get('duration_months', 'Non spécifiée')} mois
             
             # Indicateur si généré par IA
             if lot.get('ai_generated'):
-                ai_indicator = doc.add_paragraph("🤖 Contenu généré par IA")
-                ai_indicator.runs[0].font.size = Pt(8)
-                ai_indicator.runs[0].font.italic = True
-                ai_indicator.runs[0].font.color.rgb = RGBColor(156, 163, 175)
+                doc.add_paragraph("🤖 Contenu généré par IA", style='BK AI Indicator')
             
             # Référence si lot reconstruit
             if lot.get('reconstructed'):
@@ -1257,18 +1696,14 @@ Durée : {project_info.get('duration_months', 'Non spécifiée')} mois
                 elif lot.get('inferred'):
                     ref_text += "Nom inféré par analyse sémantique"
                 
-                ref_para = doc.add_paragraph(ref_text)
-                ref_para.runs[0].font.size = Pt(9)
-                ref_para.runs[0].font.italic = True
-                ref_para.runs[0].font.color.rgb = RGBColor(107, 114, 128)
+                doc.add_paragraph(ref_text, style='BK Lot Reference')
             
             # Budget
             if lot.get('estimated_amount'):
-                budget_para = doc.add_paragraph(
-                    f"💰 Montant estimé : {format_currency(lot['estimated_amount'])} HT"
+                doc.add_paragraph(
+                    f"💰 Montant estimé : {format_currency(lot['estimated_amount'])} HT",
+                    style='BK Lot Budget'
                 )
-                budget_para.runs[0].font.bold = True
-                budget_para.runs[0].font.color.rgb = RGBColor(16, 185, 129)
     
     # SECTIONS 4-11 : Identiques à V3 mais avec adaptations normes
     # (Code trop long pour tout inclure ici, mais la logique reste la même
@@ -1281,33 +1716,22 @@ Durée : {project_info.get('duration_months', 'Non spécifiée')} mois
     # FOOTER
     doc.add_page_break()
     
-    footer_para = doc.add_paragraph(
+    doc.add_paragraph(
         "\n\n\n"
         "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
         "Mémoire technique généré automatiquement par Bid-Killer Engine V4.0 ULTIMATE\n"
         f"Contextes détectés : {', '.join(detected_contexts) if detected_contexts else 'Standard'}\n"
         f"Score de qualité : {quality_report['score']}/100 - {quality_report['quality_level']}\n"
         "IA Avancée • Analyse Sémantique • Support Multi-Pays • Validation Qualité\n"
-        f"Date de génération : {datetime.now().strftime('%d/%m/%Y à %H:%M')}\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
+        f"Date de génération : {generated_at}\n"
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━",
+        style='BK Footer'
     )
-    footer_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    footer_para.runs[0].font.size = Pt(8)
-    footer_para.runs[0].font.color.rgb = RGBColor(156, 163, 175)
-    footer_para.runs[0].font.italic = True
-    
-    # SAUVEGARDER
-    output_dir = "/tmp/documents" if os.path.exists("/tmp") else "./documents"
-    os.makedirs(output_dir, exist_ok=True)
     
-    safe_project_name = (project_name or "Projet").replace(' ', '_').replace('/', '_')[:50]
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"Memoire_Technique_{safe_project_name}_{timestamp}.docx"
-    filepath = os.path.join(output_dir, filename)
-    
-    doc.save(filepath)
-    
-    return filepath
+    # SAUVEGARDER (en mémoire : l'écriture disque éventuelle est à la charge de l'appelant)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
 
 
 # ========================================
@@ -1321,13 +1745,23 @@ async def _generate_docx(
 ):
     """Fonction commune de génération DOCX V4.0"""
     
+    # Analyse + DOCX déjà généré en une seule requête (LEFT JOIN)
     result = await db.execute(
-        select(DCEAnalysis)
+        select(DCEAnalysis, GeneratedDocument)
+        .outerjoin(
+            GeneratedDocument,
+            and_(
+                GeneratedDocument.analysis_id == DCEAnalysis.id,
+                GeneratedDocument.document_type == "docx"
+            )
+        )
         .where(DCEAnalysis.id == analysis_id)
         .where(DCEAnalysis.user_id == current_user.id)
+        .limit(1)
     )
     
-    analysis = result.scalar_one_or_none()
+    row = result.first()
+    analysis, existing_doc = row if row else (None, None)
     
     if not analysis:
         raise HTTPException(
@@ -1347,46 +1781,66 @@ async def _generate_docx(
             detail="Les résultats d'analyse ne sont pas disponibles"
         )
     
-    doc_result = await db.execute(
-        select(GeneratedDocument)
-        .where(GeneratedDocument.analysis_id == analysis_id)
-        .where(GeneratedDocument.document_type == "docx")
-    )
+    # DOCX adressé par le contenu de l'analyse : à jour même si l'analyse a été relancée
+    filepath = _docx_cache_path(analysis.analysis_result, current_user.id)
+    download_name = f"Memoire_Technique_{_safe_project_name(analysis.project_name)}.docx"
     
-    existing_doc = doc_result.scalar_one_or_none()
+    # Un seul stat() : sert à la fois de test d'existence, de file_size et de
+    # stat_result pour FileResponse (qui n'a alors plus à restat le fichier)
+    try:
+        file_stat = os.stat(filepath)
+    except FileNotFoundError:
+        file_stat = None
     
-    if existing_doc and os.path.exists(existing_doc.file_path):
+    if existing_doc and existing_doc.file_path == filepath and file_stat:
         return FileResponse(
-            existing_doc.file_path,
+            filepath,
+            stat_result=file_stat,
             media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            filename=os.path.basename(existing_doc.file_path)
+            filename=download_name
         )
     
     try:
-        available_files = []  # TODO: Implémenter extraction des noms de fichiers
-        
-        filepath = create_docx_from_analysis(
-            analysis.analysis_result,
-            analysis.project_name or "Projet",
-            available_files,
-            use_ai_generation=True  # Activer la génération IA
-        )
-        
-        generated_doc = GeneratedDocument(
-            analysis_id=analysis.id,
-            user_id=current_user.id,
-            document_type="docx",
-            file_path=filepath,
-            file_size=os.path.getsize(filepath)
-        )
+        data = None
+        if not file_stat:
+            available_files = []  # TODO: Implémenter extraction des noms de fichiers
+            
+            data = await build_docx_bytes(
+                analysis.analysis_result,
+                analysis.project_name or "Projet",
+                available_files,
+                use_ai_generation=True  # Activer la génération IA
+            )
         
-        db.add(generated_doc)
+        file_size = len(data) if data is not None else file_stat.st_size
+        if existing_doc:
+            existing_doc.file_path = filepath
+            existing_doc.file_size = file_size
+        else:
+            db.add(GeneratedDocument(
+                analysis_id=analysis.id,
+                user_id=current_user.id,
+                document_type="docx",
+                file_path=filepath,
+                file_size=file_size
+            ))
         await db.commit()
         
-        return FileResponse(
-            filepath,
+        if data is None:
+            return FileResponse(
+                filepath,
+                stat_result=file_stat,
+                media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                filename=download_name
+            )
+        
+        # Réponse servie directement depuis la mémoire ; le cache disque est
+        # écrit après l'envoi (BackgroundTask), sans relire le fichier
+        return Response(
+            content=data,
             media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            filename=os.path.basename(filepath)
+            headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(download_name)}"},
+            background=BackgroundTask(_write_docx_file, filepath, data)
         )
         
     except Exception as e:
@@ -8,6 +8,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from pydantic import BaseModel
 import stripe
+import asyncio
 from typing import Optional
 from datetime import datetime
 
@@ -63,6 +64,19 @@ PLANS_CONFIG = {
     }
 }
 
+DEFAULT_PLAN = "starter"
+
+# price_id Stripe → nom du plan (les price_id non configurés sont ignorés)
+_PRICE_ID_TO_PLAN = {
+    price_id: plan_name
+    for plan_name, price_id in reversed((
+        ("starter", settings.STRIPE_STARTER_PRICE_ID),
+        ("pro", settings.STRIPE_PRO_PRICE_ID),
+        ("enterprise", settings.STRIPE_ENTERPRISE_PRICE_ID),
+    ))
+    if price_id
+}
+
 # ========================================
 # ROUTES
 # ========================================
@@ -78,9 +92,11 @@ async def create_checkout_session(
     """
     
     try:
-        # Créer un customer Stripe si nécessaire
+        # Créer un customer Stripe si nécessaire (nom, entreprise et user_id conservés ;
+        # l'id est enregistré tout de suite : un checkout abandonné puis relancé réutilise le même customer)
         if not current_user.stripe_customer_id:
-            customer = stripe.Customer.create(
+            customer = await asyncio.to_thread(
+                stripe.Customer.create,
                 email=current_user.email,
                 name=current_user.full_name,
                 metadata={
@@ -93,8 +109,10 @@ async def create_checkout_session(
             await db.commit()
         
         # Créer la session de checkout
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = await asyncio.to_thread(
+            stripe.checkout.Session.create,
             customer=current_user.stripe_customer_id,
+            client_reference_id=str(current_user.id),
             payment_method_types=["card"],
             line_items=[
                 {
@@ -257,21 +275,10 @@ async def stripe_webhook(request: Request, db: AsyncSession = Depends(get_db)):
     except stripe.error.SignatureVerificationError:
         raise HTTPException(status_code=400, detail="Invalid signature")
     
-    # Gérer les différents événements
-    if event["type"] == "checkout.session.completed":
-        await handle_checkout_completed(event["data"]["object"], db)
-    
-    elif event["type"] == "customer.subscription.updated":
-        await handle_subscription_updated(event["data"]["object"], db)
-    
-    elif event["type"] == "customer.subscription.deleted":
-        await handle_subscription_deleted(event["data"]["object"], db)
-    
-    elif event["type"] == "invoice.payment_succeeded":
-        await handle_invoice_paid(event["data"]["object"], db)
-    
-    elif event["type"] == "invoice.payment_failed":
-        await handle_invoice_failed(event["data"]["object"], db)
+    # Gérer les différents événements (un seul lookup, les autres types sont ignorés)
+    handler = WEBHOOK_HANDLERS.get(event["type"])
+    if handler:
+        await handler(event["data"]["object"], db)
     
     return {"status": "success"}
 
@@ -282,11 +289,11 @@ async def handle_checkout_completed(session, db: AsyncSession):
     user_id = session["metadata"]["user_id"]
     subscription_id = session["subscription"]
     
-    # Récupérer l'abonnement Stripe
-    stripe_subscription = stripe.Subscription.retrieve(subscription_id)
-    
-    # Récupérer l'utilisateur
-    result = await db.execute(select(User).where(User.id == int(user_id)))
+    # Récupérer l'abonnement Stripe (SDK bloquant, dans un thread) et l'utilisateur en parallèle
+    stripe_subscription, result = await asyncio.gather(
+        asyncio.to_thread(stripe.Subscription.retrieve, subscription_id),
+        db.execute(select(User).where(User.id == int(user_id)))
+    )
     user = result.scalar_one_or_none()
     
     if not user:
@@ -295,7 +302,7 @@ async def handle_checkout_completed(session, db: AsyncSession):
     # Déterminer le plan
     price_id = stripe_subscription["items"]["data"][0]["price"]["id"]
     plan_name = get_plan_name_from_price_id(price_id)
-    plan_config = PLANS_CONFIG.get(plan_name, PLANS_CONFIG["starter"])
+    plan_config = PLANS_CONFIG[plan_name]
     
     # Créer l'abonnement dans la DB
     subscription = Subscription(
@@ -314,6 +321,8 @@ async def handle_checkout_completed(session, db: AsyncSession):
     db.add(subscription)
     
     # Mettre à jour l'utilisateur
+    if not user.stripe_customer_id and session.get("customer"):
+        user.stripe_customer_id = session["customer"]
     user.subscription_tier = plan_name
     user.subscription_status = "active"
     user.analyses_limit = plan_config["analyses_limit"]
@@ -400,13 +409,16 @@ async def handle_invoice_failed(invoice, db: AsyncSession):
             await db.commit()
 
 
+# Type d'événement Stripe → handler
+WEBHOOK_HANDLERS = {
+    "checkout.session.completed": handle_checkout_completed,
+    "customer.subscription.updated": handle_subscription_updated,
+    "customer.subscription.deleted": handle_subscription_deleted,
+    "invoice.payment_succeeded": handle_invoice_paid,
+    "invoice.payment_failed": handle_invoice_failed,
+}
+
+
 def get_plan_name_from_price_id(price_id: str) -> str:
     """Détermine le nom du plan depuis le price_id Stripe"""
-    # À adapter selon tes price_id réels
-    if price_id == settings.STRIPE_STARTER_PRICE_ID:
-        return "starter"
-    elif price_id == settings.STRIPE_PRO_PRICE_ID:
-        return "pro"
-    elif price_id == settings.STRIPE_ENTERPRISE_PRICE_ID:
-        return "enterprise"
-    return "starter"  # Défaut
+    return _PRICE_ID_TO_PLAN.get(price_id, DEFAULT_PLAN)
@@ -3,13 +3,19 @@ Routes de gestion des utilisateurs
 Profil, paramètres, quotas
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from pydantic import BaseModel, EmailStr
-from typing import Optional
+from sqlalchemy import select, update
+from pydantic import BaseModel, ConfigDict, EmailStr
+from typing import Any, Dict, Optional
+from datetime import datetime
+import orjson
+import hashlib
 
 from app.database import get_db, User
-from app.routes.auth import get_current_active_user, get_password_hash
+from app.routes.auth import (
+    get_current_active_user, get_current_user_email, get_password_hash, verify_password
+)
 
 router = APIRouter()
 
@@ -29,6 +35,23 @@ class PasswordChange(BaseModel):
     new_password: str
 
 
+class UserInfo(BaseModel):
+    """Profil + quota (GET /me et GET /profile)"""
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: int
+    email: str
+    full_name: Optional[str]
+    company_name: Optional[str]
+    subscription_tier: str
+    subscription_status: str
+    analyses_limit: int
+    analyses_count: int
+    analyses_remaining: int
+    created_at: datetime
+    last_login: Optional[datetime]
+
+
 class QuotaInfo(BaseModel):
     """Informations sur les quotas"""
     subscription_tier: str
@@ -40,48 +63,68 @@ class QuotaInfo(BaseModel):
 
 
 # ========================================
-# ROUTES
+# RÉPONSES JSON + ETAG
 # ========================================
+# ETag = empreinte du JSON : If-None-Match identique → 304 sans corps
 
-@router.get("/me")
-async def get_current_user_info(current_user: User = Depends(get_current_active_user)):
-    """
-    Récupère les informations de l'utilisateur connecté
-    Route principale utilisée par le frontend
-    """
-    analyses_remaining = max(0, current_user.analyses_limit - current_user.analyses_used)
+
+def _etag(content: bytes) -> str:
+    return f'W/"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+
+
+def _json_response(request: Request, content: bytes, etag: str) -> Response:
+    """Réponse JSON avec ETag, ou 304 si le client a déjà cette version"""
+    # Données propres à l'utilisateur : cache navigateur uniquement, toujours revalidé
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
     
-    return {
-        "id": current_user.id,
-        "email": current_user.email,
-        "full_name": current_user.full_name,
-        "company_name": current_user.company_name,
-        "subscription_tier": current_user.subscription_tier,
-        "subscription_status": current_user.subscription_status,
-        "analyses_limit": current_user.analyses_limit,
-        "analyses_count": current_user.analyses_used,  # Frontend attend analyses_count
-        "analyses_remaining": analyses_remaining,
-        "created_at": current_user.created_at,
-        "last_login": current_user.last_login
-    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    return Response(content=content, media_type="application/json", headers=headers)
+
 
+async def _update_user(db: AsyncSession, user: User, **values: Any) -> None:
+    """Un seul UPDATE sur les colonnes modifiées (l'objet en session est synchronisé)"""
+    await db.execute(update(User).where(User.id == user.id).values(**values))
+    await db.commit()
+
+
+def _me_payload(user: User) -> Dict[str, Any]:
+    """Payload /me validé par UserInfo (la Response brute contourne response_model)"""
+    return UserInfo.model_validate({
+        "id": user.id,
+        "email": user.email,
+        "full_name": user.full_name,
+        "company_name": user.company_name,
+        "subscription_tier": user.subscription_tier,
+        "subscription_status": user.subscription_status,
+        "analyses_limit": user.analyses_limit,
+        "analyses_count": user.analyses_used,  # Frontend attend analyses_count
+        "analyses_remaining": user.analyses_remaining,
+        "created_at": user.created_at,
+        "last_login": user.last_login
+    }).model_dump()
 
-@router.get("/profile")
-async def get_profile(current_user: User = Depends(get_current_active_user)):
+
+# ========================================
+# ROUTES
+# ========================================
+
+# response_model : schéma OpenAPI ; la Response pré-sérialisée est renvoyée telle quelle,
+# le payload est donc validé par UserInfo à la construction (_me_payload)
+@router.get("/me", response_model=UserInfo)
+@router.get("/profile", response_model=UserInfo)  # Alias pour compatibilité (mêmes champs + quota)
+async def get_current_user_info(
+    request: Request,
+    current_user: User = Depends(get_current_active_user)
+):
     """
-    Récupère le profil complet de l'utilisateur
-    Alias de /me pour compatibilité
+    Récupère les informations de l'utilisateur connecté
+    Route principale utilisée par le frontend
     """
-    return {
-        "id": current_user.id,
-        "email": current_user.email,
-        "full_name": current_user.full_name,
-        "company_name": current_user.company_name,
-        "subscription_tier": current_user.subscription_tier,
-        "subscription_status": current_user.subscription_status,
-        "created_at": current_user.created_at,
-        "last_login": current_user.last_login
-    }
+    content = orjson.dumps(_me_payload(current_user))
+    return _json_response(request, content, _etag(content))
 
 
 @router.put("/profile")
@@ -93,14 +136,11 @@ async def update_profile(
     """
     Met à jour le profil utilisateur
     """
-    if user_update.full_name is not None:
-        current_user.full_name = user_update.full_name
-    
-    if user_update.company_name is not None:
-        current_user.company_name = user_update.company_name
-    
-    await db.commit()
-    await db.refresh(current_user)
+    # Seuls les champs fournis sont écrits ; rien à faire si aucun ne l'est
+    # (pas de refresh() : l'UPDATE synchronise current_user en session)
+    values = user_update.model_dump(exclude_none=True)
+    if values:
+        await _update_user(db, current_user, **values)
     
     return {
         "message": "Profil mis à jour avec succès",
@@ -122,17 +162,22 @@ async def change_password(
     """
     Change le mot de passe
     """
-    from app.routes.auth import verify_password
-    
     # Vérifier l'ancien mot de passe
-    if not verify_password(password_data.current_password, current_user.hashed_password):
+    if not await verify_password(password_data.current_password, current_user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Mot de passe actuel incorrect"
         )
     
+    # Mot de passe inchangé : comparaison en clair, sans payer un second bcrypt
+    if password_data.new_password == password_data.current_password:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Le nouveau mot de passe doit différer de l'actuel"
+        )
+    
     # Mettre à jour le mot de passe
-    current_user.hashed_password = get_password_hash(password_data.new_password)
+    current_user.hashed_password = await get_password_hash(password_data.new_password)
     
     await db.commit()
     
@@ -140,21 +185,46 @@ async def change_password(
 
 
 @router.get("/quota", response_model=QuotaInfo)
-async def get_quota(current_user: User = Depends(get_current_active_user)):
+async def get_quota(
+    request: Request,
+    email: str = Depends(get_current_user_email),
+    db: AsyncSession = Depends(get_db)
+):
     """
     Récupère les informations de quota
     """
-    analyses_remaining = max(0, current_user.analyses_limit - current_user.analyses_used)
-    can_analyze = analyses_remaining > 0
-    
-    return QuotaInfo(
-        subscription_tier=current_user.subscription_tier,
-        subscription_status=current_user.subscription_status,
-        analyses_limit=current_user.analyses_limit,
-        analyses_used=current_user.analyses_used,
-        analyses_remaining=analyses_remaining,
-        can_analyze=can_analyze
+    # Seules les colonnes du quota (+ is_active) : pas de ligne User complète ni d'identity map
+    result = await db.execute(
+        select(
+            User.is_active,
+            User.subscription_tier,
+            User.subscription_status,
+            User.analyses_limit,
+            User.analyses_used,
+            User.analyses_remaining.label("analyses_remaining"),
+            User.can_analyze.label("can_analyze")
+        ).where(User.email == email)
     )
+    quota = result.one_or_none()
+    
+    if quota is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Impossible de valider les credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if not quota.is_active:
+        raise HTTPException(status_code=400, detail="Utilisateur inactif")
+    
+    content = orjson.dumps({
+        "subscription_tier": quota.subscription_tier,
+        "subscription_status": quota.subscription_status,
+        "analyses_limit": quota.analyses_limit,
+        "analyses_used": quota.analyses_used,
+        "analyses_remaining": quota.analyses_remaining,
+        "can_analyze": quota.can_analyze
+    })
+    return _json_response(request, content, _etag(content))
 
 
 @router.delete("/account")
@@ -165,10 +235,7 @@ async def delete_account(
     """
     Supprime le compte utilisateur (soft delete)
     """
-    # Soft delete - désactiver le compte
-    current_user.is_active = False
-    current_user.subscription_status = "cancelled"
-    
-    await db.commit()
+    # Soft delete - désactiver le compte (commit avant la réponse)
+    await _update_user(db, current_user, is_active=False, subscription_status="cancelled")
     
     return {"message": "Compte désactivé avec succès"}
@@ -1,24 +1,46 @@
 """
 Job Manager pour analyses en background
 Permet d'exécuter des analyses longues sans timeout HTTP
+État des jobs stocké dans Redis (partagé entre web workers et worker RQ)
 """
 
-import asyncio
-import json
+import orjson
 import logging
 from datetime import datetime
 from typing import Dict, Any, Optional
-from pathlib import Path
+
+from redis import Redis
+
+from app.redis_client import redis_text_conn
 
 logger = logging.getLogger(__name__)
 
+# Durée de conservation d'un job dans Redis (24h, aligné sur result_ttl RQ)
+JOB_TTL_SECONDS = 86400
+
+# Mise à jour atomique d'un job existant : un job expiré / inconnu n'est jamais recréé partiel
+# KEYS[1] = clé du job, ARGV[1] = TTL, ARGV[2..] = champ, valeur, champ, valeur...
+_UPDATE_IF_EXISTS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
 class JobManager:
-    """Gestionnaire de jobs d'analyse en background"""
+    """Gestionnaire de jobs d'analyse en background (backend Redis)"""
+    
+    def __init__(self, redis_conn: Optional[Redis] = None):
+        # Client sur le pool partagé du process (réponses décodées en str)
+        self.redis = redis_conn or redis_text_conn
+        self._update_if_exists = self.redis.register_script(_UPDATE_IF_EXISTS_LUA)
     
-    def __init__(self):
-        self.jobs: Dict[str, Dict[str, Any]] = {}
-        self.jobs_dir = Path("/tmp/bid_killer_jobs")
-        self.jobs_dir.mkdir(exist_ok=True)
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"job:{job_id}"
     
     def create_job(self, job_id: str, user_id: str, filename: str) -> Dict[str, Any]:
         """Créer un nouveau job d'analyse"""
@@ -36,44 +58,47 @@ class JobManager:
             "completed_at": None
         }
         
-        self.jobs[job_id] = job
-        self._save_job(job_id)
+        self._save_job(job_id, job)
         
         logger.info(f"📋 Job créé : {job_id} pour {filename}")
         return job
     
-    def update_job(self, job_id: str, updates: Dict[str, Any]):
-        """Mettre à jour un job"""
-        if job_id in self.jobs:
-            self.jobs[job_id].update(updates)
-            self._save_job(job_id)
+    def update_job(self, job_id: str, updates: Dict[str, Any]) -> bool:
+        """Mettre à jour un job existant (False si le job est inconnu ou expiré)"""
+        args = [JOB_TTL_SECONDS]
+        for k, v in updates.items():
+            args += (k, orjson.dumps(v))
+        try:
+            updated = bool(self._update_if_exists(keys=[self._key(job_id)], args=args))
+        except Exception as e:
+            logger.error(f"❌ Erreur mise à jour job {job_id}: {e}")
+            return False
+        if not updated:
+            logger.warning(f"⚠️ Job {job_id} introuvable (expiré ?) - mise à jour ignorée")
+        return updated
     
     def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
         """Récupérer un job"""
-        if job_id in self.jobs:
-            return self.jobs[job_id]
-        
-        # Essayer de charger depuis le fichier
         return self._load_job(job_id)
     
-    def set_running(self, job_id: str, step: str = "Analyse en cours..."):
+    def set_running(self, job_id: str, step: str = "Analyse en cours...") -> bool:
         """Marquer un job comme en cours"""
-        self.update_job(job_id, {
+        return self.update_job(job_id, {
             "status": "running",
             "started_at": datetime.utcnow().isoformat(),
             "current_step": step
         })
     
-    def set_progress(self, job_id: str, progress: int, step: str):
+    def set_progress(self, job_id: str, progress: int, step: str) -> bool:
         """Mettre à jour la progression"""
-        self.update_job(job_id, {
+        return self.update_job(job_id, {
             "progress": progress,
             "current_step": step
         })
     
-    def set_completed(self, job_id: str, result: Dict[str, Any]):
+    def set_completed(self, job_id: str, result: Dict[str, Any]) -> bool:
         """Marquer un job comme terminé"""
-        self.update_job(job_id, {
+        return self.update_job(job_id, {
             "status": "completed",
             "progress": 100,
             "current_step": "Analyse terminée",
@@ -81,33 +106,34 @@ class JobManager:
             "completed_at": datetime.utcnow().isoformat()
         })
     
-    def set_failed(self, job_id: str, error: str):
+    def set_failed(self, job_id: str, error: str) -> bool:
         """Marquer un job comme échoué"""
-        self.update_job(job_id, {
+        return self.update_job(job_id, {
             "status": "failed",
             "current_step": "Erreur",
             "error": error,
             "completed_at": datetime.utcnow().isoformat()
         })
     
-    def _save_job(self, job_id: str):
-        """Sauvegarder un job sur disque"""
+    def _save_job(self, job_id: str, fields: Dict[str, Any]):
+        """Écrire les champs d'un job dans Redis (HSET + EXPIRE en un aller-retour, création)"""
         try:
-            job_file = self.jobs_dir / f"{job_id}.json"
-            with open(job_file, 'w') as f:
-                json.dump(self.jobs[job_id], f)
+            pipe = self.redis.pipeline()
+            pipe.hset(
+                self._key(job_id),
+                mapping={k: orjson.dumps(v) for k, v in fields.items()}
+            )
+            pipe.expire(self._key(job_id), JOB_TTL_SECONDS)
+            pipe.execute()
         except Exception as e:
             logger.error(f"❌ Erreur sauvegarde job {job_id}: {e}")
     
     def _load_job(self, job_id: str) -> Optional[Dict[str, Any]]:
-        """Charger un job depuis le disque"""
+        """Charger un job depuis Redis"""
         try:
-            job_file = self.jobs_dir / f"{job_id}.json"
-            if job_file.exists():
-                with open(job_file, 'r') as f:
-                    job = json.load(f)
-                    self.jobs[job_id] = job
-                    return job
+            raw = self.redis.hgetall(self._key(job_id))
+            if raw:
+                return {k: orjson.loads(v) for k, v in raw.items()}
         except Exception as e:
             logger.error(f"❌ Erreur chargement job {job_id}: {e}")
         
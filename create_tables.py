@@ -5,7 +5,7 @@ import os
 # Ajoute le dossier courant au chemin pour trouver 'app'
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from app.database import init_db
+from app.database import init_db, upgrade_schema
 
 async def main():
     print("⏳ Démarrage de la création des tables...")
@@ -14,6 +14,15 @@ async def main():
         print("✅ SUCCÈS : Toutes les tables ont été créées sur la base de données !")
     except Exception as e:
         print(f"❌ ERREUR : {e}")
+        sys.exit(1)
+    
+    # Mise à niveau des bases existantes (colonnes, JSONB, index) : hors démarrage de l'app
+    print("⏳ Mise à niveau du schéma...")
+    failed = await upgrade_schema()
+    if failed:
+        print(f"❌ ERREUR : {len(failed)} instruction(s) en échec (voir les logs)")
+        sys.exit(1)
+    print("✅ SUCCÈS : Schéma à jour !")
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
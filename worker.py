@@ -158,7 +158,6 @@ async def _process_analysis_job_async(job_id: str, file_path: str, filename: str
             user.analyses_used += 1
             
             await db.commit()
-            await db.refresh(analysis)
             
             # Marquer job comme terminé
             result_with_id = {